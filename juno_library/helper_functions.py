@@ -1,12 +1,38 @@
 from __future__ import annotations
 import argparse
+import gzip
+import importlib.metadata
+import io
+import json
+import os
 import subprocess
 import pathlib
-from typing import Sequence, Optional, Any
+import re
+import shutil
+import stat
+import zlib
+from typing import Callable, Sequence, Optional, Any, Tuple
+import functools
 import inspect
-import snakemake
 import ast
 
+try:
+    # python-isal is an optional, much faster drop-in replacement for gzip.
+    # IGzipFile is used instead of igzip_threaded.open: the input files are
+    # already validated in a thread pool and only their first lines are read,
+    # so a decompression thread per file would mostly read ahead for nothing
+    import isal.igzip
+
+    _GzipFile: Callable[..., io.BufferedIOBase] = isal.igzip.IGzipFile
+except ImportError:
+    _GzipFile = gzip.GzipFile
+
+# Size of the blocks that are read when counting the lines of a file
+_LINE_COUNT_CHUNK_SIZE = 128 * 1024
+
+# `conda list` shows no channel for the packages of the defaults channels
+_CONDA_DEFAULTS_CHANNEL_URL = "https://repo.anaconda.com/pkgs/"
+
 # Helper functions for text manipulation
 
 
@@ -33,64 +59,299 @@ def error_formatter(message: str) -> str:
 
 
 def validate_is_nonempty_file(
-    file_path: str | pathlib.Path, min_file_size: int = 0
+    file_path: str | pathlib.Path,
+    min_file_size: int = 0,
+    stat_result: Optional[os.stat_result] = None,
 ) -> bool:
-    file_path = pathlib.Path(file_path)
-    return file_path.is_file() and file_path.stat().st_size >= min_file_size
+    """
+    Test if file_path is a regular file of at least min_file_size bytes. If
+    the caller already has a stat_result for the file (e.g. from
+    os.DirEntry.stat()) it can be passed to avoid stat'ing the file again.
+    """
+    if stat_result is None:
+        try:
+            stat_result = os.stat(file_path)
+        except OSError:
+            return False
+    return stat.S_ISREG(stat_result.st_mode) and stat_result.st_size >= min_file_size
 
 
 def is_gz_file(filepath: str | pathlib.Path) -> bool:
+    """
+    Test if a file is gzipped. Files with a .gz extension are trusted without
+    opening them, any other file is checked for the gzip magic bytes.
+    """
+    if str(filepath).endswith(".gz"):
+        return True
     with open(filepath, "rb") as file_:
         return file_.read(2) == b"\x1f\x8b"
 
 
 def validate_file_has_min_lines(
-    file_path: str | pathlib.Path, min_num_lines: int = -1
+    file_path: str | pathlib.Path,
+    min_num_lines: int = -1,
+    stat_result: Optional[os.stat_result] = None,
 ) -> bool:
     """
-    Test if gzip file contains more than the desired number of lines.
-    Returns True/False
+    Test if a file, plain or gzipped, is non-empty and has at least
+    min_num_lines lines (after decompressing it). A stat_result of the file
+    can be passed, as for validate_is_nonempty_file. A gzipped file that
+    cannot be decompressed does not pass the test. Returns True/False
     """
-    if not validate_is_nonempty_file(file_path, min_file_size=1):
+    if not validate_is_nonempty_file(
+        file_path, min_file_size=1, stat_result=stat_result
+    ):
         return False
+    elif min_num_lines <= 0:
+        # Any non-empty file has at least one line, no need to open it
+        return True
     else:
-        with open(file_path, "rb") as f:
+        with open(file_path, "rb") as raw_file:
+            # Sniff the gzip magic bytes on the already opened file instead of
+            # trusting the extension or opening the file twice
+            is_gzipped = raw_file.read(2) == b"\x1f\x8b"
+            raw_file.seek(0)
+            f: io.BufferedIOBase = raw_file
+            if is_gzipped:
+                f = _GzipFile(fileobj=raw_file, mode="rb")
             line = 0
-            file_right_num_lines = False
-            for _lines in f:
-                line = line + 1
-                if line >= min_num_lines:
-                    file_right_num_lines = True
-                    break
-        return file_right_num_lines
+            last_chunk = b""
+            try:
+                while chunk := f.read(_LINE_COUNT_CHUNK_SIZE):
+                    line += chunk.count(b"\n")
+                    if line >= min_num_lines:
+                        return True
+                    last_chunk = chunk
+            except (OSError, EOFError, zlib.error):
+                # A truncated or corrupt gzip file (gzip.BadGzipFile is an OSError)
+                return False
+        # A last line without a trailing newline is a line as well
+        if last_chunk and not last_chunk.endswith(b"\n"):
+            line += 1
+        return line >= min_num_lines
+
+
+def write_file_if_changed(file_path: str | pathlib.Path, content: str) -> bool:
+    """
+    Write content to file_path unless the file already has exactly that
+    content, so its modification time is kept. The file is replaced
+    atomically, so a running pipeline never reads a half written file.
+    Returns True if the file was written.
+    """
+    file_path = pathlib.Path(file_path)
+    try:
+        with open(file_path, encoding="utf-8") as file_:
+            if file_.read() == content:
+                return False
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
+    tmp_path = file_path.with_name(f".{file_path.name}.tmp-{os.getpid()}")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as file_:
+            file_.write(content)
+        os.replace(tmp_path, file_path)
+    finally:
+        # Only left if writing or replacing the file failed
+        tmp_path.unlink(missing_ok=True)
+    return True
+
+
+# Helper functions for conda environments
+
+
+def get_conda_package_list(prefix: Optional[str | pathlib.Path] = None) -> str:
+    """
+    Function to list the packages installed in a conda environment (by default
+    the active one). It reads the package records in <prefix>/conda-meta and
+    the python packages installed with pip in its site-packages, which is
+    what `conda list` does as well, without the cost of starting conda in a
+    subprocess. If no conda environment can be found, or one of its package
+    records cannot be read, it falls back to `conda list`.
+    """
+    if prefix is None:
+        prefix = os.environ.get("CONDA_PREFIX")
+    if not prefix or not pathlib.Path(prefix, "conda-meta").is_dir():
+        return _run_conda_list()
+    try:
+        packages, conda_files = _read_conda_meta(pathlib.Path(prefix, "conda-meta"))
+        packages.extend(_read_pip_packages(pathlib.Path(prefix), conda_files))
+    except Exception:
+        # e.g. a partially written package record or the broken metadata of a
+        # pip package. `conda list` copes with those and the audit trail
+        # should not end the run
+        return _run_conda_list(prefix)
+
+    lines = [
+        f"# packages in environment at {prefix}:",
+        "#",
+        f"# {'Name':<25} {'Version':<16} {'Build':<19} Channel",
+    ]
+    for name, version, build, channel in sorted(packages):
+        lines.append(f"{name:<27} {version:<16} {build:<19} {channel}".rstrip())
+    return "\n".join(lines)
+
+
+def _run_conda_list(prefix: Optional[str | pathlib.Path] = None) -> str:
+    """Function to list the packages of a conda environment with `conda list`"""
+    command = ["conda", "list"]
+    if prefix is not None:
+        command += ["--prefix", str(prefix)]
+    return subprocess.check_output(command).strip().decode("utf-8")
+
+
+def _read_conda_meta(
+    meta_dir: pathlib.Path,
+) -> Tuple[list[Tuple[str, str, str, str]], set[str]]:
+    """
+    Function to read the package records in a conda-meta directory. Returns
+    the (name, version, build, channel) of every package and the files (and
+    their directories) that the packages installed, relative to the prefix.
+    """
+    packages = []
+    conda_files: set[str] = set()
+    for record_file in meta_dir.glob("*.json"):
+        with open(record_file, encoding="utf-8") as file_:
+            record = json.load(file_)
+        if not isinstance(record, dict):
+            raise ValueError(f"{record_file} is not a conda package record")
+        channel_url = str(record.get("channel", ""))
+        if channel_url.startswith(_CONDA_DEFAULTS_CHANNEL_URL):
+            channel = ""
+        else:
+            # The channel is stored as a url that ends with the platform subdir
+            channel_parts = channel_url.rstrip("/").split("/")
+            if len(channel_parts) > 1 and channel_parts[-1] == record.get("subdir"):
+                channel_parts.pop()
+            channel = channel_parts[-1]
+        packages.append(
+            (
+                str(record.get("name", "")),
+                str(record.get("version", "")),
+                str(record.get("build", "")),
+                channel,
+            )
+        )
+        for file_path in record.get("files", []):
+            conda_files.add(file_path)
+            conda_files.add(os.path.dirname(file_path))
+    return packages, conda_files
+
+
+def _read_pip_packages(
+    prefix: pathlib.Path, conda_files: set[str]
+) -> list[Tuple[str, str, str, str]]:
+    """
+    Function to list the python packages in the site-packages of prefix that
+    were not installed by conda (i.e. whose metadata is not one of the
+    conda_files). They are listed like `conda list` does, with pypi as channel.
+    """
+    packages = []
+    site_packages_dirs = [
+        *prefix.glob("lib/python*/site-packages"),
+        prefix.joinpath("Lib", "site-packages"),
+    ]
+    for site_packages in site_packages_dirs:
+        for metadata_path in [
+            *site_packages.glob("*.dist-info"),
+            *site_packages.glob("*.egg-info"),
+        ]:
+            if metadata_path.relative_to(prefix).as_posix() in conda_files:
+                continue
+            distribution = importlib.metadata.Distribution.at(metadata_path)
+            name = distribution.metadata["Name"]
+            if name is None:
+                continue
+            # conda lists the normalized name (PEP 503) of pip packages
+            name = re.sub(r"[-_.]+", "-", name).lower()
+            packages.append((name, distribution.version, "pypi_0", "pypi"))
+    return packages
 
 
 # Helper functions for handling git repositories
 
+_GIT_NOT_AVAILABLE = "Not available. This might be because this folder is not a repository or it was downloaded manually instead of through the command line."
 
-def download_git_repo(version: str, url: str, dest_dir: str | pathlib.Path) -> None:
-    """Function to download a git repo"""
-    # If updating (or simply an unfinished installation is present)
-    # the downloading will fail. Therefore, need to remove all
-    # directories with the same name
-    subprocess.run(["rm", "-rf", str(dest_dir)], check=True, timeout=60)
 
+def download_git_repo(version: str, url: str, dest_dir: str | pathlib.Path) -> None:
+    """
+    Function to download a git repo. Nothing is downloaded if dest_dir is
+    already a checkout of the requested version.
+    """
     dest_dir = pathlib.Path(dest_dir)
+    if _is_checkout_of_version(dest_dir, version, url):
+        return
     dest_dir.parent.mkdir(exist_ok=True)
 
-    subprocess.run(
-        [
-            "git",
-            "clone",
-            "-b",
-            version,
-            "--single-branch",
-            "--depth=1",
-            url,
-            str(dest_dir),
-        ],
-        check=True,
-        timeout=500,
+    # The repo is cloned next to dest_dir and only moved in place once the
+    # clone succeeded, so a failed download does not leave a broken (or no)
+    # installation behind
+    tmp_dir = dest_dir.with_name(f"{dest_dir.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    try:
+        subprocess.run(
+            [
+                "git",
+                "clone",
+                "-b",
+                version,
+                "--single-branch",
+                "--depth=1",
+                url,
+                str(tmp_dir),
+            ],
+            check=True,
+            timeout=500,
+        )
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    # If updating (or simply an unfinished installation is present) the old
+    # directory is moved aside first and only removed once the new one is in
+    # place, so there is always an installation at dest_dir
+    old_dir = dest_dir.with_name(f"{dest_dir.name}.old-{os.getpid()}")
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.lexists(dest_dir):
+        os.replace(dest_dir, old_dir)
+    try:
+        os.replace(tmp_dir, dest_dir)
+    except BaseException:
+        if os.path.lexists(old_dir):
+            os.replace(old_dir, dest_dir)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _is_checkout_of_version(gitrepo_dir: pathlib.Path, version: str, url: str) -> bool:
+    """
+    Function to check whether gitrepo_dir is a git repo cloned from url, with
+    the commit that the branch or tag version points to in that remote repo
+    """
+    if not gitrepo_dir.joinpath(".git").exists():
+        return False
+    try:
+        origin_url = subprocess.check_output(
+            ["git", "-C", str(gitrepo_dir), "config", "--get", "remote.origin.url"],
+            stderr=subprocess.DEVNULL,
+            timeout=30,
+        )
+        if origin_url.strip().decode() != url:
+            return False
+        commit = subprocess.check_output(
+            ["git", "-C", str(gitrepo_dir), "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL,
+            timeout=30,
+        )
+        # version^{} gives the commit of an annotated tag instead of the tag
+        remote_refs = subprocess.check_output(
+            ["git", "ls-remote", url, version, f"{version}^{{}}"],
+            stderr=subprocess.DEVNULL,
+            timeout=60,
+        ).decode()
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return commit.strip().decode() in (
+        line.split("\t", 1)[0] for line in remote_refs.splitlines()
     )
 
 
@@ -102,14 +363,18 @@ def get_repo_url(gitrepo_dir: str | pathlib.Path) -> str:
     it as a git repo
     """
     try:
-        url_bytes = subprocess.check_output(
+        result = subprocess.run(
             ["git", "config", "--get", "remote.origin.url"],
             cwd=f"{str(gitrepo_dir)}",
-        ).strip()
-        url = url_bytes.decode()
-    except:
-        url = "Not available. This might be because this folder is not a repository or it was downloaded manually instead of through the command line."
-    return url
+            capture_output=True,
+            timeout=30,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        # git is not installed or the directory does not exist
+        return _GIT_NOT_AVAILABLE
+    if result.returncode != 0:
+        return _GIT_NOT_AVAILABLE
+    return result.stdout.strip().decode()
 
 
 def get_commit_git(gitrepo_dir: str | pathlib.Path) -> str:
@@ -117,7 +382,7 @@ def get_commit_git(gitrepo_dir: str | pathlib.Path) -> str:
     Function to get the commit number from a folder (must be a git repo)
     """
     try:
-        commit_bytes = subprocess.check_output(
+        result = subprocess.run(
             [
                 "git",
                 "--git-dir",
@@ -127,12 +392,80 @@ def get_commit_git(gitrepo_dir: str | pathlib.Path) -> str:
                 "1",
                 '--pretty=format:"%H"',
             ],
+            capture_output=True,
+            timeout=30,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        # git is not installed
+        return _GIT_NOT_AVAILABLE
+    if result.returncode != 0:
+        return _GIT_NOT_AVAILABLE
+    return result.stdout.decode()
+
+
+def get_git_info(gitrepo_dir: str | pathlib.Path) -> Tuple[str, str]:
+    """
+    Function to get both the URL and the commit of a git repo, as used in the
+    audit trail. If the directory is not a repository, git is only called
+    once. The commit has the same format as the one of get_commit_git (in
+    double quotes), which is the format of the audit trail.
+    """
+    try:
+        commit_bytes = subprocess.check_output(
+            ["git", "-C", str(gitrepo_dir), "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL,
             timeout=30,
         )
-        commit = commit_bytes.decode()
-    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
-        commit = "Not available. This might be because this folder is not a repository or it was downloaded manually instead of through the command line."
-    return commit
+    except (OSError, subprocess.SubprocessError):
+        return _GIT_NOT_AVAILABLE, _GIT_NOT_AVAILABLE
+    commit = f'"{commit_bytes.strip().decode()}"'
+    try:
+        url = subprocess.check_output(
+            ["git", "-C", str(gitrepo_dir), "config", "--get", "remote.origin.url"],
+            timeout=30,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return _GIT_NOT_AVAILABLE, commit
+    return url.strip().decode(), commit
+
+
+_KWARG_CONSTANTS = {"True": True, "False": False, "None": None}
+# Values starting with one of these characters might be a python literal
+_KWARG_LITERAL_PREFIXES = tuple("[{('\"+-.0123456789")
+
+
+def _parse_kwarg_value(val: str) -> Any:
+    """
+    Function to convert the value of an argument passed with --snakemake-args
+    to a python object. Common values (booleans, None, integers and plain
+    strings) are converted directly, only values that look like another
+    python literal (e.g. a dict or a float) are parsed with ast.literal_eval.
+    """
+    if val in _KWARG_CONSTANTS:
+        return _KWARG_CONSTANTS[val]
+    # isdigit() alone also accepts digits that int() does not, such as "²"
+    if val.isascii() and val.isdigit():
+        return int(val)
+    if not val.startswith(_KWARG_LITERAL_PREFIXES):
+        return val
+    try:
+        return ast.literal_eval(val)
+    except (ValueError, SyntaxError):
+        # For instance when val is simply a str it cannot be parsed by literal_eval
+        return val
+
+
+@functools.lru_cache(maxsize=None)
+def _get_allowed_snakemake_args() -> frozenset[str]:
+    """
+    Function to get the arguments accepted by the snakemake python API, used
+    to validate the arguments passed through --snakemake-args. snakemake is
+    only imported here (when the argument is used) because importing it is
+    slow.
+    """
+    import snakemake
+
+    return frozenset(inspect.getfullargspec(snakemake.snakemake).args)
 
 
 class SnakemakeKwargsAction(argparse.Action):
@@ -151,23 +484,23 @@ class SnakemakeKwargsAction(argparse.Action):
         values: None | str | Sequence[str],
         option_string: Optional[str] = None,
     ) -> None:
-        allowed_snakemake_args = inspect.getfullargspec(snakemake.snakemake).args
         snakemake_args: dict[str, Any] = dict()
         if not values:
             msg = f"No arguments and values were given to --snakemake-args. Did you try to pass an extra argument to Snakemkake? Make sure that you used the API format and that you use the argument int he form: arg=value."
             raise argparse.ArgumentTypeError(error_formatter(msg))
         for arg in values:
             try:
-                key, val = arg.split("=")
+                key, val = arg.split("=", 1)
+
+                if key not in _get_allowed_snakemake_args():
+                    import snakemake
 
-                if key not in allowed_snakemake_args:
                     raise argparse.ArgumentTypeError(
                         error_formatter(
                             f"The argument {key} is not specified in the snakemake python API. Check it for typos or consult the api for the used snakemake version: {snakemake.__version__}"
                         )
                     )
-                val = ast.literal_eval(val)
-                snakemake_args[key] = val
+                snakemake_args[key] = _parse_kwarg_value(val)
             except ValueError as e:
                 if "unpack" in str(e):
                     raise argparse.ArgumentTypeError(
@@ -175,10 +508,6 @@ class SnakemakeKwargsAction(argparse.Action):
                             f"The argument {arg} is not valid. Did you try to pass an extra argument to Snakemake? Make sure that you used the API format and that you use the argument int he form: arg=value."
                         )
                     )
-                elif "malformed" in str(e):
-                    # For instance when val is simply a str it cannot be parsed by literal_eval
-                    key, val = arg.split("=")
-                    snakemake_args[key] = val
                 elif "snakemake python API" in str(e):
                     raise e
                 else:
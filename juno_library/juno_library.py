@@ -7,31 +7,80 @@ RIVM.
 All of our pipelines use Snakemake.
 """
 
+import csv
+import fnmatch
+import os
 import pathlib
 import re
 import shutil
+import socket
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
 from uuid import UUID, uuid4
 
 import yaml
-from pandas import read_csv
-from snakemake import snakemake
 
 from juno_library.helper_functions import (
     message_formatter,
     error_formatter,
     SnakemakeKwargsAction,
     validate_file_has_min_lines,
-    get_commit_git,
-    get_repo_url,
+    get_conda_package_list,
+    get_git_info,
+    write_file_if_changed,
 )
-from typing import Any, Optional, Dict, Tuple, cast, List, Union
+from typing import Any, Optional, Dict, Tuple, List, Union
 import argparse
 
+# Regex to detect different sample names in de fastq file names
+# It does NOT accept sample names that contain _1 or _2 in the name
+# because they get confused with the identifiers of forward and reverse
+# reads.
+_FASTQ_PATTERN = re.compile(
+    r"(.*?)(?:_S\d+_|_)(?:L\d{3}_)?(?:p)?R?(1|2)(?:_.*|\..*)?\.f(ast)?q(\.gz)?"
+)
+# Extensions that a file name matching _FASTQ_PATTERN ends with. Checking them
+# first is much cheaper than running the regex on every file
+_FASTQ_EXTENSIONS = (".fastq", ".fq", ".fastq.gz", ".fq.gz")
+
+# Number of threads used to validate input files when their lines are counted
+_VALIDATION_THREADS = 16
+
+try:
+    # The yaml dumper implemented in C (libyaml) is much faster, if available
+    from yaml import CSafeDumper as _YamlDumper
+except ImportError:
+    from yaml import SafeDumper as _YamlDumper  # type: ignore[assignment]
+
+# Input types (as a tuple) that correspond to an input_type given as a str
+_INPUT_TYPE_CONVERSION = {
+    "fastq": ("fastq",),
+    "fasta": ("fasta",),
+    "vcf": ("vcf",),
+    "bam": ("bam",),
+    "both": ("fastq", "fasta"),
+    "fastq_and_fasta": ("fastq", "fasta"),
+    "fastq_and_vcf": ("fastq", "vcf"),
+    "bam_and_vcf": ("bam", "vcf"),
+}
+
+# Command used to submit the jobs to an LSF cluster. The placeholders in
+# double braces are filled in by snakemake for every job
+_BSUB_TEMPLATE = (
+    "bsub -q {queue}"
+    " -n {{threads}}"
+    " -o {log_dir}/{{name}}_{{wildcards}}_{{jobid}}.out"
+    " -e {log_dir}/{{name}}_{{wildcards}}_{{jobid}}.err"
+    ' -R "span[hosts=1]"'
+    ' -R "rusage[mem={{resources.mem_gb}}G]"'
+    " -M {{resources.mem_gb}}G"
+    " -W {time_limit}"
+)
+
 
 @dataclass()
 class Pipeline:
@@ -57,10 +106,12 @@ class Pipeline:
     excluded_samples: set[str] = field(default_factory=set)
     min_num_lines: int = -1
 
-    # Setup some audit trail params
-    date_and_time: str = datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-    unique_id: UUID = uuid4()
-    hostname: str = str(subprocess.check_output(["hostname"]).strip().decode("utf-8"))
+    # Setup some audit trail params (per pipeline, not once at import)
+    date_and_time: str = field(
+        default_factory=lambda: datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+    )
+    unique_id: UUID = field(default_factory=uuid4)
+    hostname: str = field(default_factory=socket.gethostname)
 
     # These are passed to snakemake
     snakefile: str = "Snakefile"
@@ -89,30 +140,21 @@ class Pipeline:
     )
 
     parser: argparse.ArgumentParser = field(default_factory=argparse.ArgumentParser)
-    argv: list[str] = field(
-        default_factory=lambda: [x for x in sys.argv if not x.endswith(".py")]
-    )
+    # sys.argv[0] is the script (or entry point) of the pipeline
+    argv: list[str] = field(default_factory=lambda: sys.argv[1:])
 
     def __post_init__(
         self,
     ) -> None:
         # TODO: remove this line when self.input_type is a tuple in all pipelines
         if isinstance(self.input_type, str):
-            assert self.input_type in [
-                "fastq",
-                "fasta",
-                "both",
-                "vcf",
-                "bam",
-                "fastq_and_fasta",
-                "fastq_and_vcf",
-                "bam_and_vcf",
-            ], "if input_type is a str, the value can only be 'fastq', 'fasta', 'vcf', 'bam', 'both'/'fastq_and_fasta', 'fastq_and_vcf' or 'bam_and_vcf'"
+            assert (
+                self.input_type in _INPUT_TYPE_CONVERSION
+            ), "if input_type is a str, the value can only be 'fastq', 'fasta', 'vcf', 'bam', 'both'/'fastq_and_fasta', 'fastq_and_vcf' or 'bam_and_vcf'"
         elif isinstance(self.input_type, tuple):
             assert all(
                 [x in ["fastq", "fasta", "vcf", "bam"] for x in self.input_type]
             ), "if input_type is a tuple, the values can only be 'fastq', 'fasta', 'vcf' or 'bam'"
-
         self.snakemake_config["sample_sheet"] = str(self.sample_sheet)
         self.add_argument = self.parser.add_argument
         self._add_args_to_parser()
@@ -145,12 +187,14 @@ class Pipeline:
             ), f"The provided input directory ({str(self.input_dir)}) does not exist. Please provide an existing directory"
             raise e
 
-        print(
-            message_formatter(
-                "Validating that all expected input files per sample are present in the input directory..."
+        # Unlocking the output directory does not need any samples
+        if not self.unlock:
+            print(
+                message_formatter(
+                    "Validating that all expected input files per sample are present in the input directory..."
+                )
             )
-        )
-        self.__validate_sample_dict()
+            self.__validate_sample_dict()
 
         # Validate input files
         assert (
@@ -168,18 +212,26 @@ class Pipeline:
         it.
         """
         self.setup()
+        # The files are not rewritten if they did not change (e.g. when
+        # repeating a dry run), so snakemake sees the same modification time.
+        # An unlock does not enlist the samples, so it keeps the sample sheet
+        # of the run that it unlocks (if there is one)
         self.sample_sheet.parent.mkdir(exist_ok=True, parents=True)
-        with open(self.sample_sheet, "w") as f:
-            yaml.dump(self.sample_dict, f)
+        if not (self.unlock and self.sample_sheet.exists()):
+            write_file_if_changed(
+                self.sample_sheet, yaml.dump(self.sample_dict, Dumper=_YamlDumper)
+            )
 
         self.user_parameters_file.parent.mkdir(exist_ok=True, parents=True)
-        with open(self.user_parameters_file, "w") as f:
-            yaml.dump(self.user_parameters, f)
+        write_file_if_changed(
+            self.user_parameters_file, yaml.dump(self.user_parameters)
+        )
         print(message_formatter(f"Running {self.pipeline_name} pipeline."))
 
-        # Generate pipeline audit trail only if not dryrun (or unlock)
+        # Generate pipeline audit trail only if not dryrun or unlock, so an
+        # unlock does not overwrite the audit trail of the run it unlocks
         # store the exclusion file in the audit_trail as well
-        if not self.dryrun or self.unlock:
+        if not (self.dryrun or self.unlock):
             self.audit_trail_files = self._generate_audit_trail()
 
         if self.local:
@@ -191,26 +243,18 @@ class Pipeline:
                 "log", "cluster"
             )
             cluster_log_dir.mkdir(parents=True, exist_ok=True)
-            cluster = (
-                'bsub -q %s \
-                    -n {threads} \
-                    -o %s/{name}_{wildcards}_{jobid}.out \
-                    -e %s/{name}_{wildcards}_{jobid}.err \
-                    -R "span[hosts=1]" \
-                    -R "rusage[mem={resources.mem_gb}G]" \
-                    -M {resources.mem_gb}G \
-                    -W %s '
-                % (
-                    str(self.queue),
-                    str(cluster_log_dir),
-                    str(cluster_log_dir),
-                    str(self.time_limit),
-                )
+            cluster = _BSUB_TEMPLATE.format(
+                queue=self.queue,
+                log_dir=cluster_log_dir,
+                time_limit=self.time_limit,
             )
             self.snakemake_args["cluster"] = cluster
 
         self.snakemake_args["jobname"] = self.pipeline_name + "_{name}.jobid{jobid}"
 
+        # snakemake is only imported when it is needed because importing it is slow
+        from snakemake import snakemake
+
         pipeline_run_successful: bool = snakemake(
             self.snakefile,
             workdir=str(self.workdir),
@@ -284,6 +328,13 @@ class Pipeline:
             default=60,
             help="Time limit per job in minutes (passed as -W argument to bsub). Jobs will be killed if not finished in this time.",
         )
+        self.add_argument(
+            "--retries",
+            type=int,
+            metavar="INT",
+            default=None,
+            help="Number of times a failed job is restarted (passed as restart_times to snakemake). Useful on a busy cluster, where jobs can fail for transient reasons such as a bsub timeout.",
+        )
         self.add_argument(
             "-u",
             "--unlock",
@@ -335,11 +386,14 @@ class Pipeline:
         self.dryrun: bool = args.dryrun
         self.time_limit: int = args.time_limit
         self.queue: str = args.queue
+        if args.retries is not None:
+            self.snakemake_args["restart_times"] = args.retries
 
         self.workdir: Path = args.workdir.resolve()
         self.input_dir: Path = args.input.resolve()
         self.output_dir: Path = args.output.resolve()
-        self.path_to_audit = self.output_dir.joinpath("audit_trail").resolve()
+        # output_dir is already resolved, so there is no need to resolve again
+        self.path_to_audit = self.output_dir.joinpath("audit_trail")
         self.snakemake_report = self.path_to_audit.joinpath("snakemake_report.html")
         self.snakemake_config["input_dir"] = str(self.input_dir)
         self.snakemake_config["output_dir"] = str(self.output_dir)
@@ -376,13 +430,22 @@ class Pipeline:
         -----
         Per pattern, multiple hits can be expected (e.g. multiple cgMLST output directories in one run).
         This function does not distinguish between files and directories.
+        The first part of every pattern is matched against the (cached)
+        listing of the input directory, only deeper patterns are globbed.
+        It stops at the first pattern without a hit, so patterns without
+        wildcards (cheap to check) should be given first.
 
         """
-        checks_all_patterns = [False] * len(expected_files_dirs)
-        for i, file_or_dir_pattern in enumerate(expected_files_dirs):
-            nr_files_this_pattern = len(list(self.input_dir.glob(file_or_dir_pattern)))
-            checks_all_patterns[i] = nr_files_this_pattern > 0
-        return all(checks_all_patterns)
+        names = [entry.name for entry in self.__scan_dir(self.input_dir)]
+        for file_or_dir_pattern in expected_files_dirs:
+            top_level_pattern, _, sub_pattern = file_or_dir_pattern.partition("/")
+            if not fnmatch.filter(names, top_level_pattern):
+                return False
+            if sub_pattern and (
+                next(self.input_dir.glob(file_or_dir_pattern), None) is None
+            ):
+                return False
+        return True
 
     def __parse_input_type(self) -> None:
         """
@@ -391,19 +454,26 @@ class Pipeline:
         This function can be deprecated when all pipelines have switched to using a tuple for self.input_type.
 
         """
-        conversion_dict = {
-            "fastq": ("fastq",),
-            "fasta": ("fasta",),
-            "vcf": ("vcf",),
-            "bam": ("bam",),
-            "both": ("fastq", "fasta"),
-            "fastq_and_fasta": ("fastq", "fasta"),
-            "fastq_and_vcf": ("fastq", "vcf"),
-            "bam_and_vcf": ("bam", "vcf"),
-        }
         # check if self.input_type is a str or a tuple
         if isinstance(self.input_type, str):
-            self.input_type = tuple(conversion_dict[self.input_type])
+            self.input_type = _INPUT_TYPE_CONVERSION[self.input_type]
+
+    def __set_expected_input_types(self) -> None:
+        """Set the flags for the input types in self.input_type.
+
+        They are set once per sample_dict that is built (and not in
+        __post_init__), so an input_type that is changed after the
+        pipeline was created is used as well.
+        """
+        input_types = (
+            _INPUT_TYPE_CONVERSION[self.input_type]
+            if isinstance(self.input_type, str)
+            else self.input_type
+        )
+        self._expects_fastq = "fastq" in input_types
+        self._expects_fasta = "fasta" in input_types
+        self._expects_vcf = "vcf" in input_types
+        self._expects_bam = "bam" in input_types
 
     def __build_sample_dict(self) -> None:
         """Look for samples in input_dir and set self.sample_dict accordingly.
@@ -411,7 +481,9 @@ class Pipeline:
         It also checks whether the input_dir is an output dir if
         juno_assembly and sets self.input_dir_is_juno_assembly_output.
         """
+        self.__set_expected_input_types()
         self.sample_dict: dict[str, dict[str, str]] = {}
+        self.__dir_entries: Dict[str, List[os.DirEntry[str]]] = {}
         self.input_dir_is_juno_assembly_output = self.__check_input_dir(
             ["clean_fastq", "de_novo_assembly_filtered"]
         )
@@ -419,11 +491,15 @@ class Pipeline:
             ["mapped_reads/duprem", "variants", "reference/reference.fasta"]
         )
         self.input_dir_is_juno_variant_typing_output = self.__check_input_dir(
-            ["*/consensus", "audit_trail"]
+            ["audit_trail", "*/consensus"]
         )
         self.input_dir_is_juno_cgmlst_output = self.__check_input_dir(
-            ["cgmlst/*", "audit_trail"]
+            ["audit_trail", "cgmlst/*"]
         )
+        if self.unlock:
+            # Unlocking the output directory does not need any samples, so
+            # the input files are not searched for
+            return
         if self.input_dir_is_juno_assembly_output:
             self.__enlist_fastq_samples(self.input_dir.joinpath("clean_fastq"))
             self.__enlist_samples_custom_extension(
@@ -459,18 +535,18 @@ class Pipeline:
             # self.__enlist_samples_custom_extension(self.input_dir.joinpath("cgmlst"), extension=".tsv", key="cgmlst")
         else:
             self.__parse_input_type()  # TODO: remove this line when self.input_type is a list in all pipelines
-            if "fastq" in self.input_type:
+            if self._expects_fastq:
                 self.__enlist_fastq_samples(self.input_dir)
-            if "fasta" in self.input_type:
+            if self._expects_fasta:
                 self.__enlist_samples_custom_extension(
                     self.input_dir, extension=".fasta", key="assembly"
                 )
-            if "vcf" in self.input_type:
+            if self._expects_vcf:
                 self.__enlist_samples_custom_extension(
                     self.input_dir, extension=".vcf", key="vcf"
                 )
                 self.__enlist_reference(self.input_dir)
-            if "bam" in self.input_type:
+            if self._expects_bam:
                 self.__enlist_samples_custom_extension(
                     self.input_dir, extension=".bam", key="bam"
                 )
@@ -482,47 +558,47 @@ class Pipeline:
 
         {sample: {R1: fastq_file1, R2: fastq_file2}}
         """
-        # Regex to detect different sample names in de fastq file names
-        # It does NOT accept sample names that contain _1 or _2 in the name
-        # because they get confused with the identifiers of forward and reverse
-        # reads.
         # TODO: add functionality to enlist samples with only one fastq file for ONT sequencing
-        pattern = re.compile(
-            r"(.*?)(?:_S\d+_|_)(?:L\d{3}_)?(?:p)?R?(1|2)(?:_.*|\..*)?\.f(ast)?q(\.gz)?"
-        )
         observed_combinations: Dict[Tuple[str, str], str] = {}
         errors = []
-        for file_ in dir.iterdir():
-            filepath_ = str(file_.resolve())
-            if validate_file_has_min_lines(file_, self.min_num_lines):
-                if match := pattern.fullmatch(file_.name):
-                    sample_name = match.group(1)
-                    read_group = match.group(2)
-                    if sample_name in self.excluded_samples:
-                        continue
-                    # check if sample_name and read_group combination is already seen before
-                    # if this happens, it might be that the sample is spread over multiple sequencing lanes
-                    if (sample_name, read_group) in observed_combinations:
-                        observed_file = observed_combinations[sample_name, read_group]
-                        errors.append(
-                            KeyError(
-                                f"Multiple fastq files ({observed_file} and {filepath_}) matching the same sample ({sample_name}) and read group ({read_group}). This pipeline expects only one fastq file per sample and read group."
-                            )
-                        )
-                    else:
-                        observed_combinations[(sample_name, read_group)] = filepath_
-                    sample = self.sample_dict.setdefault(match.group(1), {})
-                    sample[f"R{read_group}"] = filepath_
+        # Plain strings are much cheaper to join than Path objects
+        resolved_dir = str(dir.resolve())
+        matched_files = []
+        for entry in self.__scan_dir(dir):
+            if not entry.name.endswith(_FASTQ_EXTENSIONS) or not entry.is_file():
+                continue
+            match = _FASTQ_PATTERN.fullmatch(entry.name)
+            if match and match.group(1) not in self.excluded_samples:
+                matched_files.append((entry, match))
+        valid_files = self.__validate_files([entry for entry, _ in matched_files])
+        for (entry, match), is_valid in zip(matched_files, valid_files):
+            if not is_valid:
+                continue
+            filepath_ = self.__resolve_entry(entry, resolved_dir)
+            sample_name = match.group(1)
+            read_group = match.group(2)
+            # check if sample_name and read_group combination is already seen before
+            # if this happens, it might be that the sample is spread over multiple sequencing lanes
+            if (sample_name, read_group) in observed_combinations:
+                observed_file = observed_combinations[sample_name, read_group]
+                errors.append(
+                    KeyError(
+                        f"Multiple fastq files ({observed_file} and {filepath_}) matching the same sample ({sample_name}) and read group ({read_group}). This pipeline expects only one fastq file per sample and read group."
+                    )
+                )
+            else:
+                observed_combinations[(sample_name, read_group)] = filepath_
+            sample = self.sample_dict.setdefault(sample_name, {})
+            sample[f"R{read_group}"] = filepath_
         if len(errors) == 1:
             raise errors[0]
         elif len(errors) > 1:
             raise KeyError(errors)
 
     def __enlist_reference(self, dir: Path) -> None:
-        ref_path = dir.joinpath("reference", "reference.fasta")
-        for sample in self.sample_dict:
-            if "reference" not in self.sample_dict[sample]:
-                self.sample_dict[sample]["reference"] = str(ref_path.resolve())
+        ref_path = str(dir.joinpath("reference", "reference.fasta").resolve())
+        for files in self.sample_dict.values():
+            files.setdefault("reference", ref_path)
 
     def __enlist_samples_custom_extension(
         self, dir: Path, extension: str, key: str
@@ -532,15 +608,62 @@ class Pipeline:
 
         {sample: {key: file.extension}}
         """
-        pattern = re.compile(f"(.*?){extension}")
-        for file_ in dir.iterdir():
-            if validate_file_has_min_lines(file_, self.min_num_lines):
-                if match := pattern.fullmatch(file_.name):
-                    sample_name = match.group(1)
-                    if sample_name in self.excluded_samples:
-                        continue
-                    sample = self.sample_dict.setdefault(sample_name, {})
-                    sample[key] = str(file_.resolve())
+        resolved_dir = str(dir.resolve())
+        matched_files = []
+        for entry in self.__scan_dir(dir):
+            if not entry.name.endswith(extension) or not entry.is_file():
+                continue
+            sample_name = entry.name[: -len(extension)]
+            if sample_name not in self.excluded_samples:
+                matched_files.append((entry, sample_name))
+        valid_files = self.__validate_files([entry for entry, _ in matched_files])
+        for (entry, sample_name), is_valid in zip(matched_files, valid_files):
+            if is_valid:
+                sample = self.sample_dict.setdefault(sample_name, {})
+                sample[key] = self.__resolve_entry(entry, resolved_dir)
+
+    @staticmethod
+    def __resolve_entry(entry: os.DirEntry[str], resolved_dir: str) -> str:
+        """Get the resolved path of an entry of resolved_dir.
+
+        Joining the name to the (already resolved) directory is enough,
+        except for symlinks, which are recorded by their target.
+        """
+        if entry.is_symlink():
+            return os.path.realpath(entry.path)
+        return os.path.join(resolved_dir, entry.name)
+
+    def __scan_dir(self, dir: Path) -> List[os.DirEntry[str]]:
+        """List the entries of dir.
+
+        Several input types are often enlisted from the same directory,
+        so every directory is only listed once per sample_dict that is
+        built. The DirEntry objects also cache their stat, which is
+        shared by all the input types then.
+        """
+        key = os.fspath(dir)
+        if key not in self.__dir_entries:
+            with os.scandir(dir) as entries:
+                self.__dir_entries[key] = list(entries)
+        return self.__dir_entries[key]
+
+    def __validate_files(self, entries: List[os.DirEntry[str]]) -> List[bool]:
+        """Run validate_file_has_min_lines on every entry.
+
+        Counting lines means reading the files, which is I/O bound, so
+        in that case the files are validated in a thread pool. The
+        results are returned in the same order as the entries.
+        """
+
+        def validate(entry: os.DirEntry[str]) -> bool:
+            return validate_file_has_min_lines(
+                entry.path, self.min_num_lines, stat_result=entry.stat()
+            )
+
+        if self.min_num_lines <= 0 or len(entries) < 2:
+            return [validate(entry) for entry in entries]
+        with ThreadPoolExecutor(max_workers=_VALIDATION_THREADS) as executor:
+            return list(executor.map(validate, entries))
 
     def __set_exluded_samples(self) -> None:
         """Read self.exclusion file and set self.excluded_sameples.
@@ -551,8 +674,9 @@ class Pipeline:
         """
         if self.exclusion_file:
             with open(self.exclusion_file, "r") as f:
+                # strip() also removes the \r of files written on Windows
                 self.excluded_samples: set[str] = {
-                    x.replace("\n", "") for x in f.readlines()
+                    sample for line in f if (sample := line.strip())
                 }
 
     def __validate_sample_dict(self) -> bool:
@@ -575,43 +699,31 @@ class Pipeline:
                 )
             )
         errors = []
-        if "fastq" in self.input_type:
-            for sample in self.sample_dict:
-                R1_present = "R1" in self.sample_dict[sample].keys()
-                R2_present = "R2" in self.sample_dict[sample].keys()
-                if not R1_present or not R2_present:
-                    errors.append(
-                        KeyError(
-                            f"One of the paired fastq files (R1 or R2) are missing for sample {sample}. This pipeline ONLY ACCEPTS PAIRED READS. If you are sure you have complete paired-end reads, make sure to NOT USE _1 and _2 within your file names unless it is to differentiate paired fastq files or any unsupported character (Supported: letters, numbers, underscores)."
-                        )
+        for sample, files in self.sample_dict.items():
+            if self._expects_fastq and ("R1" not in files or "R2" not in files):
+                errors.append(
+                    KeyError(
+                        f"One of the paired fastq files (R1 or R2) are missing for sample {sample}. This pipeline ONLY ACCEPTS PAIRED READS. If you are sure you have complete paired-end reads, make sure to NOT USE _1 and _2 within your file names unless it is to differentiate paired fastq files or any unsupported character (Supported: letters, numbers, underscores)."
                     )
-        if "fasta" in self.input_type:
-            for sample in self.sample_dict:
-                assembly_present = self.sample_dict[sample].keys()
-                if "assembly" not in assembly_present:
-                    errors.append(
-                        KeyError(
-                            f"The assembly is missing for sample {sample}. This pipeline expects an assembly per sample."
-                        )
+                )
+            if self._expects_fasta and "assembly" not in files:
+                errors.append(
+                    KeyError(
+                        f"The assembly is missing for sample {sample}. This pipeline expects an assembly per sample."
                     )
-        if "vcf" in self.input_type:
-            for sample in self.sample_dict:
-                vcf_present = self.sample_dict[sample].keys()
-                if "vcf" not in vcf_present:
-                    errors.append(
-                        KeyError(
-                            f"The VCF file is missing for sample {sample}. This pipeline expects a VCF per sample."
-                        )
+                )
+            if self._expects_vcf and "vcf" not in files:
+                errors.append(
+                    KeyError(
+                        f"The VCF file is missing for sample {sample}. This pipeline expects a VCF per sample."
                     )
-        if "bam" in self.input_type:
-            for sample in self.sample_dict:
-                bam_present = self.sample_dict[sample].keys()
-                if "bam" not in bam_present:
-                    errors.append(
-                        KeyError(
-                            f"The BAM file is missing for sample {sample}. This pipeline expects a BAM per sample."
-                        )
+                )
+            if self._expects_bam and "bam" not in files:
+                errors.append(
+                    KeyError(
+                        f"The BAM file is missing for sample {sample}. This pipeline expects a BAM per sample."
                     )
+                )
         if len(errors) == 0:
             return True
         if len(errors) == 1:
@@ -626,6 +738,9 @@ class Pipeline:
     ) -> None:
         """Expects csv with metadata per sample, sets self.juno_metadata dict.
 
+        The metadata of every sample is a dict with the other columns of the
+        csv as keys. All values are str, an empty (or missing) cell is "".
+
         Args:
             filepath (Optional[Path], optional): The location of the csv. Defaults to None.
             expected_colnames (list[str], optional): The expected header of the csv. Defaults to ["sample", "genus"].
@@ -640,17 +755,40 @@ class Pipeline:
             )
         else:
             juno_species_file = filepath.resolve()
-        if juno_species_file.exists():
-            sample_metadata = read_csv(juno_species_file, dtype={"sample": str})
-            assert all(
-                [col in sample_metadata.columns for col in expected_colnames]
-            ), error_formatter(
-                f'The provided metadata file ({filepath}) does not contain one or more of the expected column names ({",".join(expected_colnames)}). Are you using the right capitalization for the column names?'
+        try:
+            # utf-8-sig skips the byte order mark that e.g. Excel writes, which
+            # would otherwise be part of the first column name
+            file_ = open(juno_species_file, encoding="utf-8-sig", newline="")
+        except FileNotFoundError:
+            # Without the file there is simply no metadata
+            return
+        with file_:
+            sample_metadata = csv.DictReader(file_, restval="")
+            missing_colnames = set(expected_colnames).difference(
+                sample_metadata.fieldnames or []
             )
-            sample_metadata.set_index("sample", inplace=True)
-            self.juno_metadata = cast(
-                Dict[str, Any], sample_metadata.to_dict(orient="index")
+            assert not missing_colnames, error_formatter(
+                f'The provided metadata file ({filepath}) does not contain one or more of the expected column names ({",".join(expected_colnames)}). Missing: {",".join(sorted(missing_colnames))}. Are you using the right capitalization for the column names?'
             )
+            juno_metadata: dict[str, Any] = {}
+            for row in sample_metadata:
+                # DictReader stores the cells that do not fit in the header
+                # under the key None
+                if None in row:
+                    raise ValueError(
+                        error_formatter(
+                            f"Line {sample_metadata.line_num} of the provided metadata file ({juno_species_file}) has more values than the header has column names."
+                        )
+                    )
+                sample = row.pop("sample")
+                if sample in juno_metadata:
+                    raise ValueError(
+                        error_formatter(
+                            f"The sample {sample} is found more than once in the provided metadata file ({juno_species_file}). Every sample should have only one row."
+                        )
+                    )
+                juno_metadata[sample] = row
+            self.juno_metadata = juno_metadata
 
     def __write_git_audit_file(self, git_file: Path) -> None:
         """Function to get URL and commit from pipeline repo.
@@ -659,9 +797,10 @@ class Pipeline:
             git_file (Path): The file that the info is written to.
         """
 
-        git_audit = {"repo": get_repo_url("."), "commit": get_commit_git(".")}
+        repo_url, commit = get_git_info(".")
+        git_audit = {"repo": repo_url, "commit": commit}
         with open(git_file, "w") as file:
-            yaml.dump(git_audit, file, default_flow_style=False)
+            yaml.dump(git_audit, file, Dumper=_YamlDumper, default_flow_style=False)
 
     def _write_pipeline_audit_file(self, pipeline_file: Path) -> None:
         """Get the pipeline_info and print it to a file for audit trail."""
@@ -670,14 +809,14 @@ class Pipeline:
             "pipeline_version": self.pipeline_version,
             "timestamp": self.date_and_time,
             "hostname": self.hostname,
-            "run_id": self.unique_id,
+            "run_id": str(self.unique_id),
         }
         with open(pipeline_file, "w") as file:
-            yaml.dump(pipeline_info, file, default_flow_style=False)
+            yaml.dump(pipeline_info, file, Dumper=_YamlDumper, default_flow_style=False)
 
     def __write_conda_audit_file(self, conda_file: Path) -> None:
         """Get list of environments in current conda environment."""
-        conda_audit = subprocess.check_output(["conda", "list"]).strip().decode("utf-8")
+        conda_audit = get_conda_package_list()
         with open(conda_file, "w") as file:
             file.writelines("Master environment list:\n\n")
             file.write(str(conda_audit))
@@ -693,12 +832,12 @@ class Pipeline:
         self.path_to_audit.mkdir(parents=True, exist_ok=True)
         print(message_formatter(f"Making audit trail in {str(self.path_to_audit)}."))
 
-        assert pathlib.Path(
+        assert os.path.exists(
             self.sample_sheet
-        ).exists(), f"The sample sheet ({str(self.sample_sheet)}) does not exist. Either this file was not created properly by the pipeline or was deleted before starting the pipeline."
-        assert pathlib.Path(
+        ), f"The sample sheet ({str(self.sample_sheet)}) does not exist. Either this file was not created properly by the pipeline or was deleted before starting the pipeline."
+        assert os.path.exists(
             self.user_parameters_file
-        ).exists(), f"The provided user_parameters ({self.user_parameters_file}) does not exist. Either this file was not created properly by the pipeline or was deleted before starting the pipeline"
+        ), f"The provided user_parameters ({self.user_parameters_file}) does not exist. Either this file was not created properly by the pipeline or was deleted before starting the pipeline"
 
         git_file = self.path_to_audit.joinpath("log_git.yaml")
         self.__write_git_audit_file(git_file)
@@ -713,15 +852,9 @@ class Pipeline:
             shutil.copy(self.exclusion_file, self.path_to_audit)
 
         user_parameters_audit_file = self.path_to_audit.joinpath("user_parameters.yaml")
-        subprocess.run(
-            ["cp", self.user_parameters_file, user_parameters_audit_file],
-            check=True,
-            timeout=60,
-        )
+        shutil.copyfile(self.user_parameters_file, user_parameters_audit_file)
         samples_audit_file = self.path_to_audit.joinpath("sample_sheet.yaml")
-        subprocess.run(
-            ["cp", self.sample_sheet, samples_audit_file], check=True, timeout=60
-        )
+        shutil.copyfile(self.sample_sheet, samples_audit_file)
         return [
             git_file,
             conda_file,
@@ -736,6 +869,8 @@ class Pipeline:
         Note that it expects that the output files were already produced
         by the run_snakemake function
         """
+        from snakemake import snakemake
+
         print(message_formatter(f"Generating snakemake report for audit trail..."))
         # The copy of the sample sheet that was generated for audit trail is
         # used instead of the original sample sheet. This is to avoid that if
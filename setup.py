@@ -1,15 +1,17 @@
 from __future__ import print_function
 
-from juno_library.version import (
-    __package_name__,
-    __version__,
-    __email__,
-    __description__,
-    __authors__,
-    __license__,
-)
+import os
+import runpy
 import sys
 
+# The package information is read from version.py without importing
+# juno_library, which would import all its dependencies as well
+package_info = runpy.run_path(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "juno_library", "version.py"
+    )
+)
+
 if sys.version_info < (3, 9):
     print(
         "At least Python 3.10 is required for the Juno pipelines to work.\n",
@@ -29,17 +31,19 @@ except ImportError:
 
 
 setup(
-    name=__package_name__,
-    version=__version__,
-    author=__authors__,
-    author_email=__email__,
-    description=__description__,
+    name=package_info["__package_name__"],
+    version=package_info["__version__"],
+    author=package_info["__authors__"],
+    author_email=package_info["__email__"],
+    description=package_info["__description__"],
     zip_safe=False,
-    license=__license__,
+    license=package_info["__license__"],
     packages=find_packages(),
     scripts=["juno_library/run.py"],
     package_data={"juno_library": ["envs/*", "py.typed"]},
     install_requires=[
+        # juno_library itself does not use pandas anymore, but the Juno
+        # pipelines get pandas through it, so it cannot be dropped silently
         "pandas>=1.5",
         "pandas-stubs>=1.5",
         "drmaa>=0.7.9",
@@ -52,6 +56,9 @@ setup(
         "mypy>=1.1",
         "pip>=23",
     ],
+    # python-isal is optional, it makes counting the lines of gzipped input
+    # files faster (pip install juno_library[isal])
+    extras_require={"isal": ["isal>=1.0"]},
     entry_points={"console_scripts": ["juno_pipeline = juno_library.run:main"]},
     include_package_data=True,
 )
@@ -1,32 +1,64 @@
 from __future__ import annotations
+import gzip
 import os
 
 import argparse
 from pathlib import Path
 from sys import path
+import shutil
 import subprocess
+import tempfile
 import unittest
+from unittest import mock
 from typing import Any
 
+import yaml
+
 from juno_library import Pipeline
 from juno_library.helper_functions import (
     error_formatter,
+    is_gz_file,
     message_formatter,
     SnakemakeKwargsAction,
     validate_file_has_min_lines,
     get_commit_git,
+    download_git_repo,
+    get_conda_package_list,
+    get_git_info,
     get_repo_url,
+    write_file_if_changed,
 )
 
-main_script_path = str(Path(__file__).absolute().parent.parent)
-path.insert(0, main_script_path)
+main_script_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if main_script_path not in path:
+    path.insert(0, main_script_path)
+# A checkout has .git (a dir, or a file for worktrees and submodules)
+main_script_is_git_repo = os.path.exists(os.path.join(main_script_path, ".git"))
+# Used as an example of a directory that is not a git repo
+home_dir = os.path.expanduser("~")
+# os.path.exists is False (instead of raising) if the dir cannot be accessed
+in_rivm_hpc = os.path.exists("/data/BioGrid/hernanda/")
 
 
 def make_non_empty_file(
-    file_path: str | Path, content: str = "this\nfile\nhas\ncontents"
+    file_path: str | Path, content: bytes = b"this\nfile\nhas\ncontents"
 ) -> None:
-    with open(file_path, "w") as file_:
-        file_.write(content)
+    # Written with a single write call (no text mode buffering)
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, content)
+    finally:
+        os.close(fd)
+
+
+def gzip_file(file_path: str | Path) -> None:
+    """Compress a file to <file_path>.gz and remove the original (like
+    gzip -f), without starting a gzip process"""
+    with open(file_path, "rb") as file_in, gzip.open(
+        f"{file_path}.gz", "wb"
+    ) as file_out:
+        shutil.copyfileobj(file_in, file_out)
+    os.unlink(file_path)
 
 
 default_args: dict[str, Any] = dict(
@@ -34,6 +66,8 @@ default_args: dict[str, Any] = dict(
     pipeline_version="v0.0.0",
 )
 default_argv = ["i", "fake_input", "-o", "fake_output_dir", "--local"]
+# What the git helpers return for a directory that is not a git repo
+git_not_available = "Not available. This might be because this folder is not a repository or it was downloaded manually instead of through the command line."
 
 
 class TestTextJunoHelpers(unittest.TestCase):
@@ -51,13 +85,30 @@ class TestTextJunoHelpers(unittest.TestCase):
 class TestFileJunoHelpers(unittest.TestCase):
     """Testing File Helper Functions"""
 
+    empty_gz_file = "empty_fixture.txt.gz"
+    nonempty_gz_file = "nonempty_fixture.txt.gz"
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """Making the gzipped fixtures (that are only read by the tests)"""
+        with gzip.open(cls.empty_gz_file, "wb"):
+            pass
+        with gzip.open(cls.nonempty_gz_file, "wb") as file_:
+            file_.write(b"this\nfile\nhas\ncontents")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Removing the gzipped fixtures"""
+        Path(cls.empty_gz_file).unlink(missing_ok=True)
+        Path(cls.nonempty_gz_file).unlink(missing_ok=True)
+
     def test_validate_file_has_min_lines(self) -> None:
         """Testing that the function to check whether a file is empty works.
         It should return True if nonempty file"""
         nonempty_file = "nonempty.txt"
         make_non_empty_file(nonempty_file)
         self.assertTrue(validate_file_has_min_lines(nonempty_file))
-        os.system(f"rm -f {nonempty_file}")
+        Path(nonempty_file).unlink(missing_ok=True)
 
     def test_validate_file_has_min_lines_2(self) -> None:
         """Testing that the function to check whether a file is empty works.
@@ -66,39 +117,80 @@ class TestFileJunoHelpers(unittest.TestCase):
         empty_file = "empty.txt"
         open(empty_file, "a").close()
         self.assertFalse(validate_file_has_min_lines(empty_file, min_num_lines=1))
-        os.system(f"rm -f {empty_file}")
+        Path(empty_file).unlink(missing_ok=True)
 
     def test_validate_is_nonempty_when_gzipped(self) -> None:
         """Testing that the function to check whether a gzipped file is empty
         works. It should return True if file is empty but no min_num_lines is
         given and False if empty file and a min_num_lines of at least 1"""
-        empty_file = "empty.txt"
-        open(empty_file, "a").close()
-        os.system(f"gzip -f {empty_file}")
-        self.assertTrue(validate_file_has_min_lines(f"{empty_file}.gz"))
+        self.assertTrue(validate_file_has_min_lines(self.empty_gz_file))
         self.assertFalse(
-            validate_file_has_min_lines(f"{empty_file}.gz", min_num_lines=3)
+            validate_file_has_min_lines(self.empty_gz_file, min_num_lines=3)
         )
-        os.system(f"rm -f {empty_file}")
-        os.system(f"rm -f {empty_file}.gz")
+
+    def test_validate_file_has_min_lines_when_gzipped(self) -> None:
+        """Testing that the lines of a gzipped file are counted after
+        decompressing it, including a last line without a newline"""
+        self.assertTrue(
+            validate_file_has_min_lines(self.nonempty_gz_file, min_num_lines=4)
+        )
+        self.assertFalse(
+            validate_file_has_min_lines(self.nonempty_gz_file, min_num_lines=5)
+        )
+
+    def test_validate_file_has_min_lines_when_gzip_is_corrupt(self) -> None:
+        """Testing that a truncated or corrupt gzipped file does not pass the
+        validation (instead of raising an error)"""
+        corrupt_gz_file = "corrupt.txt.gz"
+        for content in [
+            b"\x1f\x8bgarbage",
+            gzip.compress(b"this\nfile\nhas\ncontents")[:-10],
+        ]:
+            with self.subTest(content=content):
+                make_non_empty_file(corrupt_gz_file, content=content)
+                self.assertFalse(
+                    validate_file_has_min_lines(corrupt_gz_file, min_num_lines=1)
+                )
+        Path(corrupt_gz_file).unlink(missing_ok=True)
+
+    def test_is_gz_file(self) -> None:
+        """Testing that gzipped files are recognized by their extension or,
+        if the extension is missing, by their magic bytes"""
+        plain_file = "plain.txt"
+        make_non_empty_file(plain_file)
+        self.assertFalse(is_gz_file(plain_file))
+        gzip_file(plain_file)
+        self.assertTrue(is_gz_file(f"{plain_file}.gz"))
+        os.replace(f"{plain_file}.gz", plain_file)
+        self.assertTrue(is_gz_file(plain_file))
+        Path(plain_file).unlink(missing_ok=True)
+
+    def test_write_file_if_changed(self) -> None:
+        """Testing that a file is only written if its content changes"""
+        file_path = Path("written.txt")
+        self.assertTrue(write_file_if_changed(file_path, "content"))
+        self.assertFalse(write_file_if_changed(file_path, "content"))
+        self.assertTrue(write_file_if_changed(file_path, "other content"))
+        self.assertEqual(file_path.read_text(), "other content")
+        with mock.patch("os.replace", side_effect=OSError), self.assertRaises(OSError):
+            write_file_if_changed(file_path, "new content")
+        self.assertEqual(file_path.read_text(), "other content")
+        self.assertEqual(list(Path(".").glob(f".{file_path.name}.tmp-*")), [])
+        file_path.unlink(missing_ok=True)
 
 
 class TestJunoHelpers(unittest.TestCase):
     """Testing Helper Functions"""
 
     @unittest.skipIf(
-        not Path("/data/BioGrid/hernanda/").exists(),
+        not in_rivm_hpc,
         "Skipped in GitHub Actions because it unexplicably (so far) fails there",
     )
     def test_git_url_of_base_juno_pipeline(self) -> None:
         """Testing if the git URL is retrieved properly (taking this folder
         as example
         """
-        try:
-            is_repo = subprocess.check_output(
-                ["git", "rev-parse", "--git-dir"], cwd=main_script_path
-            )
-        except:
+        if not main_script_is_git_repo:
             self.skipTest(
                 "The directory containint this package is not a git repo, therefore test was skipped"
             )
@@ -116,145 +208,276 @@ class TestJunoHelpers(unittest.TestCase):
         """Testing that the url is 'not available' when the directory is not
         a git repo
         """
-        self.assertEqual(
-            get_repo_url(os.path.expanduser("~")),
-            "Not available. This might be because this folder is not a repository or it was downloaded manually instead of through the command line.",
-        )
+        self.assertEqual(get_repo_url(home_dir), git_not_available)
 
     @unittest.skipIf(
-        not Path("/data/BioGrid/hernanda/").exists(),
+        not in_rivm_hpc,
         "Skipped in GitHub Actions because it unexplicably (so far) fails there",
     )
     def test_get_commit_git_from_repo(self) -> None:
         """Testing that the git commit function works"""
-        try:
-            is_repo = subprocess.check_output(
-                ["git", "rev-parse", "--git-dir"], cwd=main_script_path
+        if not main_script_is_git_repo:
+            self.skipTest(
+                "The directory containint this package is not a git repo, therefore test was skipped"
             )
-        except:
+        commit = get_commit_git(main_script_path)
+        self.assertIsInstance(commit, str)
+        self.assertNotEqual(commit, git_not_available)
+
+    def test_get_git_info_from_non_git_repo(self) -> None:
+        """Testing that both the url and the commit are 'not available' when
+        the directory is not a git repo"""
+        self.assertEqual(
+            get_git_info(home_dir),
+            (git_not_available, git_not_available),
+        )
+
+    @unittest.skipIf(shutil.which("git") is None, "git is not installed")
+    def test_get_git_info_matches_other_git_helpers(self) -> None:
+        """Testing that get_git_info gives the same url and commit (in the
+        same format) as get_repo_url and get_commit_git"""
+        if not main_script_is_git_repo:
             self.skipTest(
                 "The directory containint this package is not a git repo, therefore test was skipped"
             )
-        commit_available = (
-            get_commit_git(main_script_path)
-            == "Not available. This might be because this folder is not a repository or it was downloaded manually instead of through the command line."
+        self.assertEqual(
+            get_git_info(main_script_path),
+            (get_repo_url(main_script_path), get_commit_git(main_script_path)),
         )
-        self.assertIsInstance(get_commit_git(main_script_path), str)
-        self.assertFalse(commit_available)
 
-    def test_get_commit_git_from_non_git_repo(self) -> None:
-        """Testing that the git commit function gives right output when no git repo"""
-        self.assertIsInstance(get_commit_git(os.path.expanduser("~")), str)
+    def test_git_info_when_git_is_not_installed(self) -> None:
+        """Testing that the git helpers return 'not available' instead of
+        raising when the git executable cannot be found"""
+        with mock.patch.dict(os.environ, {"PATH": ""}):
+            self.assertEqual(get_repo_url(main_script_path), git_not_available)
+            self.assertEqual(get_commit_git(main_script_path), git_not_available)
+
+    @unittest.skipIf(shutil.which("git") is None, "git is not installed")
+    def test_download_git_repo_skips_up_to_date_checkout(self) -> None:
+        """Testing that a git repo is cloned and that it is not downloaded
+        again if the checkout is already at the requested version of the same
+        remote repo"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            remote = Path(tmp_dir, "fake_remote_repo")
+            other_remote = Path(tmp_dir, "fake_other_remote_repo")
+            git = ["git", "-c", "user.name=test", "-c", "user.email=test@test"]
+            subprocess.run(git + ["init", "-q", "-b", "main", str(remote)], check=True)
+            make_non_empty_file(remote.joinpath("file.txt"))
+            subprocess.run(git + ["-C", str(remote), "add", "file.txt"], check=True)
+            subprocess.run(
+                git + ["-C", str(remote), "commit", "-q", "-m", "test"], check=True
+            )
+            # A different remote repo with the same commit
+            subprocess.run(
+                git + ["clone", "-q", str(remote), str(other_remote)], check=True
+            )
+            dest_dir = Path(tmp_dir, "fake_clone", "repo")
+            download_git_repo("main", str(remote), dest_dir)
+            self.assertTrue(dest_dir.joinpath("file.txt").exists())
+            dest_dir.joinpath("file.txt").unlink()
+            download_git_repo("main", str(remote), dest_dir)
+            self.assertFalse(dest_dir.joinpath("file.txt").exists())
+            download_git_repo("main", str(other_remote), dest_dir)
+            self.assertTrue(dest_dir.joinpath("file.txt").exists())
+            self.assertEqual(os.listdir(dest_dir.parent), ["repo"])
+
+    def test_get_conda_package_list(self) -> None:
+        """Testing that the packages of a conda environment are listed from
+        its conda-meta directory, together with the packages installed with
+        pip, and that `conda list` is used if a package record is malformed"""
+        conda_env = Path("fake_conda_env")
+        self.addCleanup(shutil.rmtree, conda_env, ignore_errors=True)
+        conda_meta = conda_env.joinpath("conda-meta")
+        conda_meta.mkdir(parents=True, exist_ok=True)
+        site_packages = conda_env.joinpath("lib", "python3.11", "site-packages")
+        make_non_empty_file(
+            conda_meta.joinpath("snakemake-7.32.0-hdfd78af_0.json"),
+            content=b'{"name": "snakemake", "version": "7.32.0", "build": "hdfd78af_0", "channel": "https://conda.anaconda.org/bioconda/noarch", "subdir": "noarch", "files": ["lib/python3.11/site-packages/snakemake-7.32.0.dist-info/METADATA"]}',
+        )
+        make_non_empty_file(conda_meta.joinpath("history"), content=b"")
+        for name, version in [("snakemake", "7.32.0"), ("Fake_Pip.Package", "1.0")]:
+            dist_info = f"{name}-{version}.dist-info"
+            site_packages.joinpath(dist_info).mkdir(parents=True)
+            make_non_empty_file(
+                site_packages.joinpath(dist_info, "METADATA"),
+                content=f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n".encode(),
+            )
+        package_list = get_conda_package_list(conda_env).splitlines()
+        self.assertEqual(len(package_list), 5)
+        self.assertEqual(
+            package_list[-2].split(), ["fake-pip-package", "1.0", "pypi_0", "pypi"]
+        )
         self.assertEqual(
-            get_commit_git(os.path.expanduser("~")),
-            "Not available. This might be because this folder is not a repository or it was downloaded manually instead of through the command line.",
+            package_list[-1].split(), ["snakemake", "7.32.0", "hdfd78af_0", "bioconda"]
         )
 
+        # e.g. the metadata of a broken egg-info
+        with mock.patch(
+            "importlib.metadata.Distribution.at", side_effect=TypeError
+        ), mock.patch("subprocess.check_output", return_value=b"conda list\n") as m:
+            self.assertEqual(get_conda_package_list(conda_env), "conda list")
+        m.assert_called_once_with(["conda", "list", "--prefix", str(conda_env)])
+
+        make_non_empty_file(conda_meta.joinpath("partial-1.0-0.json"), content=b"{")
+        with mock.patch("subprocess.check_output", return_value=b"conda list\n") as m:
+            self.assertEqual(get_conda_package_list(conda_env), "conda list")
+        m.assert_called_once_with(["conda", "list", "--prefix", str(conda_env)])
+
+    @unittest.skipIf(shutil.which("conda") is None, "conda is not installed")
+    def test_get_conda_package_list_matches_conda_list(self) -> None:
+        """Testing that the packages listed from conda-meta and site-packages
+        are the ones that `conda list` gives for a real conda environment"""
+        prefix = os.environ.get("CONDA_PREFIX") or (
+            subprocess.check_output(["conda", "info", "--base"]).strip().decode()
+        )
+        conda_list = subprocess.check_output(["conda", "list", "--prefix", prefix])
+        # Only the column widths may differ
+        self.assertEqual(
+            [line.split() for line in get_conda_package_list(prefix).splitlines()],
+            [line.split() for line in conda_list.decode().strip().splitlines()],
+        )
+
+    def test_get_commit_git_from_non_git_repo(self) -> None:
+        """Testing that the git commit function gives right output when no git repo"""
+        commit = get_commit_git(home_dir)
+        self.assertIsInstance(commit, str)
+        self.assertEqual(commit, git_not_available)
+
 
 class TestPipelineStartup(unittest.TestCase):
     """Testing the pipeline startup (generating dict with samples) from general
     Juno pipelines"""
 
     maxDiff = None
+    cwd: str
+    tmp_dir: str
+    wsamples_dir: Path
+    wsamples_exclusion_dir: Path
+    juno_dir: Path
+    expected_fastq: dict[str, dict[str, str]]
+    expected_fasta: dict[str, dict[str, str]]
+    expected_both: dict[str, dict[str, str]]
 
     @classmethod
     def setUpClass(cls) -> None:
         """Making fake directories and files to test different case scenarios
-        for starting pipeline"""
+        for starting pipeline. They are made in a temporary directory, so
+        removing that directory is enough to clean up"""
+        cls.cwd = os.getcwd()
+        cls.tmp_dir = tempfile.mkdtemp(prefix="juno_library_tests_")
+        # Class cleanups also run if setUpClass fails (tearDownClass does
+        # not), so the other test classes always start in the original cwd.
+        # They run in reverse order: first back to the cwd, then remove
+        cls.addClassCleanup(shutil.rmtree, cls.tmp_dir, ignore_errors=True)
+        cls.addClassCleanup(os.chdir, cls.cwd)
+        os.chdir(cls.tmp_dir)
+
+        # Directories that contain fake files are made from the file paths
         fake_dirs = [
             "fake_dir_empty",
-            "fake_dir_wsamples",
-            "fake_dir_wsamples/reference",
-            "fake_dir_wsamples_exclusion",
             "exclusion_file",
-            "fake_dir_incomplete",
-            "fake_dir_juno",
-            "fake_dir_juno/clean_fastq",
-            "fake_dir_juno/de_novo_assembly_filtered",
             "fake_dir_juno/identify_species",
-            "fake_1_in_fastqname",
-            "fake_multiple_library_samples",
-            "fake_dir_juno_assembly_output",
-            "fake_dir_juno_mapping_output",
-            "fake_dir_juno_variant_typing_output",
-            "fake_dir_juno_cgmlst_output",
+            "fake_dir_juno_variant_typing_output/audit_trail",
+            "fake_dir_juno_cgmlst_output/audit_trail",
             "fake_dir_wsamples_juno_cgmlst",
         ]
 
+        # The paired reads of sample1 and sample2 are in several input dirs
+        fastq_files = [
+            "sample1_R1.fastq",
+            "sample1_R2.fastq.gz",
+            "sample2_R1_filt.fq",
+            "sample2_R2_filt.fq.gz",
+        ]
+        fake_files_per_dir = {
+            "fake_dir_wsamples": [
+                *fastq_files,
+                "sample1.fasta",
+                "sample2.fasta",
+                "sample1.vcf",
+                "sample2.vcf",
+                "reference/reference.fasta",
+            ],
+            "fake_dir_wsamples_exclusion": [
+                *fastq_files,
+                "sample1.fasta",
+                "sample2.fasta",
+            ],
+            "fake_dir_incomplete": [*fastq_files, "sample2.fasta"],
+            "fake_dir_juno": [
+                "clean_fastq/1234_R1.fastq.gz",
+                "clean_fastq/1234_R2.fastq.gz",
+                "de_novo_assembly_filtered/1234.fasta",
+            ],
+            "fake_1_in_fastqname": ["1234_1_R1.fastq.gz", "1234_1_R2.fastq.gz"],
+            "fake_multiple_library_samples": [
+                f"sample5_S1_{lane}_{read}.fastq.gz"
+                for lane in ("L001", "L002")
+                for read in ("R1", "R2")
+            ],
+            "fake_dir_juno_assembly_output": [
+                "clean_fastq/sample_A_R1.fastq.gz",
+                "clean_fastq/sample_A_R2.fastq.gz",
+                "de_novo_assembly_filtered/sample_A.fasta",
+            ],
+            "fake_dir_juno_mapping_output": [
+                "mapped_reads/duprem/sample_A.bam",
+                "variants/sample_A.vcf",
+                "reference/reference.fasta",
+            ],
+            "fake_dir_juno_variant_typing_output": [
+                "mtb_typing/consensus/sample_A.fasta"
+            ],
+            "fake_dir_juno_cgmlst_output": [
+                f"cgmlst/{species}/per_sample/sample_A.tsv"
+                for species in ("escherichia", "stec", "shigella")
+            ],
+        }
         fake_files = [
-            "fake_dir_wsamples/sample1_R1.fastq",
-            "fake_dir_wsamples/sample1_R2.fastq.gz",
-            "fake_dir_wsamples/sample2_R1_filt.fq",
-            "fake_dir_wsamples/sample2_R2_filt.fq.gz",
-            "fake_dir_wsamples/sample1.fasta",
-            "fake_dir_wsamples/sample2.fasta",
-            "fake_dir_wsamples/sample1.vcf",
-            "fake_dir_wsamples/sample2.vcf",
-            "fake_dir_wsamples/reference/reference.fasta",
-            "fake_dir_wsamples_exclusion/sample1_R1.fastq",
-            "fake_dir_wsamples_exclusion/sample1_R2.fastq.gz",
-            "fake_dir_wsamples_exclusion/sample2_R1_filt.fq",
-            "fake_dir_wsamples_exclusion/sample2_R2_filt.fq.gz",
-            "fake_dir_wsamples_exclusion/sample1.fasta",
-            "fake_dir_wsamples_exclusion/sample2.fasta",
-            "exclusion_file.exclude",
-            "fake_dir_incomplete/sample1_R1.fastq",
-            "fake_dir_incomplete/sample1_R2.fastq.gz",
-            "fake_dir_incomplete/sample2_R1_filt.fq",
-            "fake_dir_incomplete/sample2_R2_filt.fq.gz",
-            "fake_dir_incomplete/sample2.fasta",
-            "fake_dir_juno/clean_fastq/1234_R1.fastq.gz",
-            "fake_dir_juno/clean_fastq/1234_R2.fastq.gz",
-            "fake_dir_juno/de_novo_assembly_filtered/1234.fasta",
-            "fake_1_in_fastqname/1234_1_R1.fastq.gz",
-            "fake_1_in_fastqname/1234_1_R2.fastq.gz",
-            "fake_multiple_library_samples/sample5_S1_L001_R1.fastq.gz",
-            "fake_multiple_library_samples/sample5_S1_L001_R2.fastq.gz",
-            "fake_multiple_library_samples/sample5_S1_L002_R1.fastq.gz",
-            "fake_multiple_library_samples/sample5_S1_L002_R2.fastq.gz",
+            f"{folder}/{file_}"
+            for folder, files in fake_files_per_dir.items()
+            for file_ in files
         ]
 
-        for folder in fake_dirs:
-            Path(folder).mkdir(exist_ok=True, parents=True)
+        for folder in set(fake_dirs).union(os.path.dirname(f) for f in fake_files):
+            os.makedirs(folder, exist_ok=True)
         for file_ in fake_files:
             make_non_empty_file(file_)
-        bracken_dir = Path("fake_dir_juno").joinpath("identify_species")
-        bracken_dir.mkdir(parents=True, exist_ok=True)
-        bracken_multireport_path = bracken_dir.joinpath("top1_species_multireport.csv")
-        bracken_multireport_content = "sample,genus,species\n1234,salmonella,enterica\n"
+        bracken_multireport_path = Path(
+            "fake_dir_juno", "identify_species", "top1_species_multireport.csv"
+        )
+        bracken_multireport_content = (
+            b"sample,genus,species\n1234,salmonella,enterica\n"
+        )
         make_non_empty_file(
             bracken_multireport_path, content=bracken_multireport_content
         )
+        make_non_empty_file("exclusion_file.exclude", content=b"sample1")
 
-        for fake_file in fake_files:
-            if fake_file == "exclusion_file.exclude":
-                make_non_empty_file(fake_file, content="sample1")
+        # The expected paths are absolute, so the input dirs are resolved once
+        cls.wsamples_dir = Path("fake_dir_wsamples").resolve()
+        cls.wsamples_exclusion_dir = Path("fake_dir_wsamples_exclusion").resolve()
+        cls.juno_dir = Path("fake_dir_juno").resolve()
 
-    @classmethod
-    def tearDownClass(cls) -> None:
-        """Removing fake directories/files"""
-        fake_dirs = [
-            "fake_dir_empty",
-            "fake_dir_wsamples",
-            "fake_dir_wsamples_library_names",
-            "fake_dir_wsamples_exclusion",
-            "exclusion_file",
-            "fake_dir_incomplete",
-            "fake_dir_juno",
-            "fake_dir_juno/clean_fastq",
-            "fake_dir_juno/de_novo_assembly_filtered",
-            "fake_dir_juno/identify_species",
-            "fake_1_in_fastqname",
-            "fake_multiple_library_samples",
-            "fake_dir_juno_assembly_output",
-            "fake_dir_juno_mapping_output",
-            "fake_dir_juno_variant_typing_output",
-            "fake_dir_juno_cgmlst_output",
-            "fake_dir_wsamples_juno_cgmlst",
-        ]
-
-        for folder in fake_dirs:
-            os.system("rm -rf {}".format(str(folder)))
+        # The sample dicts expected for fake_dir_wsamples per input type
+        cls.expected_fastq = {
+            "sample1": {
+                "R1": str(cls.wsamples_dir.joinpath("sample1_R1.fastq")),
+                "R2": str(cls.wsamples_dir.joinpath("sample1_R2.fastq.gz")),
+            },
+            "sample2": {
+                "R1": str(cls.wsamples_dir.joinpath("sample2_R1_filt.fq")),
+                "R2": str(cls.wsamples_dir.joinpath("sample2_R2_filt.fq.gz")),
+            },
+        }
+        cls.expected_fasta = {
+            sample: {"assembly": str(cls.wsamples_dir.joinpath(f"{sample}.fasta"))}
+            for sample in ["sample1", "sample2"]
+        }
+        cls.expected_both = {
+            sample: {**cls.expected_fastq[sample], **cls.expected_fasta[sample]}
+            for sample in ["sample1", "sample2"]
+        }
 
     def test_nonexisting_dir(self) -> None:
         """Testing the pipeline startup fails if the input directory does not
@@ -297,46 +520,19 @@ class TestPipelineStartup(unittest.TestCase):
 
     def test_correctdir_fastq(self) -> None:
         """Testing the pipeline startup accepts fastq and fastq.gz files"""
-
-        expected_output = {
-            "sample1": {
-                "R1": str(
-                    Path("fake_dir_wsamples").joinpath("sample1_R1.fastq").resolve()
-                ),
-                "R2": str(
-                    Path("fake_dir_wsamples").joinpath("sample1_R2.fastq.gz").resolve()
-                ),
-            },
-            "sample2": {
-                "R1": str(
-                    Path("fake_dir_wsamples").joinpath("sample2_R1_filt.fq").resolve()
-                ),
-                "R2": str(
-                    Path("fake_dir_wsamples")
-                    .joinpath("sample2_R2_filt.fq.gz")
-                    .resolve()
-                ),
-            },
-        }
         pipeline = Pipeline(
             **default_args, argv=["-i", "fake_dir_wsamples"], input_type="fastq"
         )
         pipeline.setup()
-        self.assertDictEqual(pipeline.sample_dict, expected_output)
+        self.assertDictEqual(pipeline.sample_dict, self.expected_fastq)
 
     def test_excludefile(self) -> None:
         """Testing the pipeline startup accepts and works with exclusion file on fastq and fastq.gz files"""
         expected_output = {
             "sample2": {
-                "R1": str(
-                    Path("fake_dir_wsamples_exclusion")
-                    .joinpath("sample2_R1_filt.fq")
-                    .resolve()
-                ),
+                "R1": str(self.wsamples_exclusion_dir.joinpath("sample2_R1_filt.fq")),
                 "R2": str(
-                    Path("fake_dir_wsamples_exclusion")
-                    .joinpath("sample2_R2_filt.fq.gz")
-                    .resolve()
+                    self.wsamples_exclusion_dir.joinpath("sample2_R2_filt.fq.gz")
                 ),
             }
         }
@@ -348,6 +544,25 @@ class TestPipelineStartup(unittest.TestCase):
         pipeline.setup()
         self.assertDictEqual(pipeline.sample_dict, expected_output)
 
+    def test_excludefile_with_windows_line_endings(self) -> None:
+        """Testing the pipeline startup ignores the carriage returns and
+        empty lines of an exclusion file"""
+        make_non_empty_file("exclusion_file_crlf.exclude", content=b"sample1\r\n\r\n")
+        pipeline = Pipeline(
+            **default_args,
+            argv=[
+                "-i",
+                "fake_dir_wsamples_exclusion",
+                "-ex",
+                "exclusion_file_crlf.exclude",
+            ],
+            input_type="fastq",
+        )
+        pipeline.setup()
+        self.assertEqual(pipeline.excluded_samples, {"sample1"})
+        self.assertEqual(list(pipeline.sample_dict), ["sample2"])
+        Path("exclusion_file_crlf.exclude").unlink(missing_ok=True)
+
     def test_correctdir_fastq_with_library_in_filename(self) -> None:
         """Testing the pipeline startup accepts fastq and fastq.gz files"""
 
@@ -387,62 +602,50 @@ class TestPipelineStartup(unittest.TestCase):
         pipeline.setup()
         self.assertDictEqual(pipeline.sample_dict, expected_output)
 
+    def test_correctdir_with_symlinked_files(self) -> None:
+        """Testing that symlinked input files are enlisted with the path of
+        the file they link to"""
+        input_dir = Path("fake_dir_symlinks", "in")
+        real_dir = Path("fake_dir_symlinks", "real")
+        input_dir.mkdir(parents=True)
+        real_dir.mkdir()
+        for read_group in ["R1", "R2"]:
+            make_non_empty_file(real_dir.joinpath(f"s1_{read_group}.fastq"))
+            input_dir.joinpath(f"s1_{read_group}.fastq").symlink_to(
+                Path("..", "real", f"s1_{read_group}.fastq")
+            )
+        pipeline = Pipeline(
+            **default_args,
+            argv=["-i", str(input_dir)],
+            input_type="fastq",
+        )
+        pipeline.setup()
+        self.assertDictEqual(
+            pipeline.sample_dict,
+            {
+                "s1": {
+                    "R1": str(real_dir.resolve().joinpath("s1_R1.fastq")),
+                    "R2": str(real_dir.resolve().joinpath("s1_R2.fastq")),
+                }
+            },
+        )
+
     def test_correctdir_fasta(self) -> None:
         """Testing the pipeline startup accepts fasta"""
-
-        expected_output = {
-            "sample1": {
-                "assembly": str(
-                    Path("fake_dir_wsamples").joinpath("sample1.fasta").resolve()
-                )
-            },
-            "sample2": {
-                "assembly": str(
-                    Path("fake_dir_wsamples").joinpath("sample2.fasta").resolve()
-                )
-            },
-        }
         pipeline = Pipeline(
             **default_args, argv=["-i", "fake_dir_wsamples"], input_type="fasta"
         )
         pipeline.setup()
-        self.assertDictEqual(pipeline.sample_dict, expected_output)
+        self.assertDictEqual(pipeline.sample_dict, self.expected_fasta)
 
     def test_correctdir_both(self) -> None:
         """Testing the pipeline startup accepts both types"""
-
-        expected_output = {
-            "sample1": {
-                "R1": str(
-                    Path("fake_dir_wsamples").joinpath("sample1_R1.fastq").resolve()
-                ),
-                "R2": str(
-                    Path("fake_dir_wsamples").joinpath("sample1_R2.fastq.gz").resolve()
-                ),
-                "assembly": str(
-                    Path("fake_dir_wsamples").joinpath("sample1.fasta").resolve()
-                ),
-            },
-            "sample2": {
-                "R1": str(
-                    Path("fake_dir_wsamples").joinpath("sample2_R1_filt.fq").resolve()
-                ),
-                "R2": str(
-                    Path("fake_dir_wsamples")
-                    .joinpath("sample2_R2_filt.fq.gz")
-                    .resolve()
-                ),
-                "assembly": str(
-                    Path("fake_dir_wsamples").joinpath("sample2.fasta").resolve()
-                ),
-            },
-        }
         pipeline = Pipeline(
             **default_args, argv=["-i", "fake_dir_wsamples"], input_type="both"
         )
         pipeline.setup()
         pipeline.get_metadata_from_csv_file()
-        self.assertDictEqual(pipeline.sample_dict, expected_output)
+        self.assertDictEqual(pipeline.sample_dict, self.expected_both)
         self.assertIsNone(pipeline.juno_metadata)
 
     def test_correctdir_fastq_and_vcf(self) -> None:
@@ -450,33 +653,19 @@ class TestPipelineStartup(unittest.TestCase):
 
         expected_output = {
             "sample1": {
-                "R1": str(
-                    Path("fake_dir_wsamples").joinpath("sample1_R1.fastq").resolve()
-                ),
-                "R2": str(
-                    Path("fake_dir_wsamples").joinpath("sample1_R2.fastq.gz").resolve()
-                ),
-                "vcf": str(Path("fake_dir_wsamples").joinpath("sample1.vcf").resolve()),
+                "R1": str(self.wsamples_dir.joinpath("sample1_R1.fastq")),
+                "R2": str(self.wsamples_dir.joinpath("sample1_R2.fastq.gz")),
+                "vcf": str(self.wsamples_dir.joinpath("sample1.vcf")),
                 "reference": str(
-                    Path("fake_dir_wsamples")
-                    .joinpath("reference", "reference.fasta")
-                    .resolve()
+                    self.wsamples_dir.joinpath("reference", "reference.fasta")
                 ),
             },
             "sample2": {
-                "R1": str(
-                    Path("fake_dir_wsamples").joinpath("sample2_R1_filt.fq").resolve()
-                ),
-                "R2": str(
-                    Path("fake_dir_wsamples")
-                    .joinpath("sample2_R2_filt.fq.gz")
-                    .resolve()
-                ),
-                "vcf": str(Path("fake_dir_wsamples").joinpath("sample2.vcf").resolve()),
+                "R1": str(self.wsamples_dir.joinpath("sample2_R1_filt.fq")),
+                "R2": str(self.wsamples_dir.joinpath("sample2_R2_filt.fq.gz")),
+                "vcf": str(self.wsamples_dir.joinpath("sample2.vcf")),
                 "reference": str(
-                    Path("fake_dir_wsamples")
-                    .joinpath("reference", "reference.fasta")
-                    .resolve()
+                    self.wsamples_dir.joinpath("reference", "reference.fasta")
                 ),
             },
         }
@@ -517,19 +706,17 @@ class TestPipelineStartup(unittest.TestCase):
         expected_output = {
             "sample1": {
                 "cgmlst_escherichia": str(
-                    Path("fake_dir_wsamples_juno_cgmlst")
-                    .joinpath("cgmlst", "escherichia", "per_sample", "sample1.tsv")
-                    .resolve()
+                    input_dir.joinpath(
+                        "cgmlst", "escherichia", "per_sample", "sample1.tsv"
+                    )
                 ),
                 "cgmlst_stec": str(
-                    Path("fake_dir_wsamples_juno_cgmlst")
-                    .joinpath("cgmlst", "stec", "per_sample", "sample1.tsv")
-                    .resolve()
+                    input_dir.joinpath("cgmlst", "stec", "per_sample", "sample1.tsv")
                 ),
                 "cgmlst_shigella": str(
-                    Path("fake_dir_wsamples_juno_cgmlst")
-                    .joinpath("cgmlst", "shigella", "per_sample", "sample1.tsv")
-                    .resolve()
+                    input_dir.joinpath(
+                        "cgmlst", "shigella", "per_sample", "sample1.tsv"
+                    )
                 ),
             },
         }
@@ -543,33 +730,6 @@ class TestPipelineStartup(unittest.TestCase):
 
     def test_correctdir_with_input_type_as_tuple(self) -> None:
         """Testing the pipeline startup accepts both types"""
-
-        expected_output = {
-            "sample1": {
-                "R1": str(
-                    Path("fake_dir_wsamples").joinpath("sample1_R1.fastq").resolve()
-                ),
-                "R2": str(
-                    Path("fake_dir_wsamples").joinpath("sample1_R2.fastq.gz").resolve()
-                ),
-                "assembly": str(
-                    Path("fake_dir_wsamples").joinpath("sample1.fasta").resolve()
-                ),
-            },
-            "sample2": {
-                "R1": str(
-                    Path("fake_dir_wsamples").joinpath("sample2_R1_filt.fq").resolve()
-                ),
-                "R2": str(
-                    Path("fake_dir_wsamples")
-                    .joinpath("sample2_R2_filt.fq.gz")
-                    .resolve()
-                ),
-                "assembly": str(
-                    Path("fake_dir_wsamples").joinpath("sample2.fasta").resolve()
-                ),
-            },
-        }
         pipeline = Pipeline(
             **default_args,
             argv=["-i", "fake_dir_wsamples"],
@@ -577,36 +737,32 @@ class TestPipelineStartup(unittest.TestCase):
         )
         pipeline.setup()
         pipeline.get_metadata_from_csv_file()
-        print(pipeline.sample_dict)
-        self.assertDictEqual(pipeline.sample_dict, expected_output)
+        self.assertDictEqual(pipeline.sample_dict, self.expected_both)
         self.assertIsNone(pipeline.juno_metadata)
 
+    def test_input_type_changed_after_creation(self) -> None:
+        """Testing that an input_type that is set after the pipeline was
+        created is used to enlist and validate the samples"""
+        pipeline = Pipeline(
+            **default_args,
+            argv=["-i", "fake_dir_wsamples"],
+            input_type="fasta",
+        )
+        pipeline.input_type = "fastq"
+        pipeline.setup()
+        self.assertDictEqual(pipeline.sample_dict, self.expected_fastq)
+
     def test_recognize_juno_assembly_output(self) -> None:
         """
         Testing that the pipeline recognizes the output of the Juno assembly pipeline
         """
-
-        input_dir = Path("fake_dir_juno_assembly_output").resolve()
-        input_dir.mkdir(exist_ok=True, parents=True)
-        input_dir.joinpath("clean_fastq").mkdir(exist_ok=True, parents=True)
-        input_dir.joinpath("de_novo_assembly_filtered").mkdir(
-            exist_ok=True, parents=True
-        )
-
-        make_non_empty_file(input_dir.joinpath("clean_fastq", "sample_A_R1.fastq.gz"))
-        make_non_empty_file(input_dir.joinpath("clean_fastq", "sample_A_R2.fastq.gz"))
-        make_non_empty_file(
-            input_dir.joinpath("de_novo_assembly_filtered", "sample_A.fasta")
-        )
-
-        pipeline = Pipeline(
-            **default_args, argv=["-i", str(input_dir)], input_type="both"
-        )
+        input_dir = "fake_dir_juno_assembly_output"
+        pipeline = Pipeline(**default_args, argv=["-i", input_dir], input_type="both")
         pipeline.setup()
         self.assertTrue(pipeline.input_dir_is_juno_assembly_output)
 
         pipeline_input_type_list = Pipeline(
-            **default_args, argv=["-i", str(input_dir)], input_type=("fastq", "fasta")
+            **default_args, argv=["-i", input_dir], input_type=("fastq", "fasta")
         )
         pipeline_input_type_list.setup()
         self.assertTrue(pipeline_input_type_list.input_dir_is_juno_assembly_output)
@@ -615,21 +771,10 @@ class TestPipelineStartup(unittest.TestCase):
         """
         Testing that the pipeline recognizes the output of the Juno mapping pipeline
         """
-
-        input_dir = Path("fake_dir_juno_mapping_output").resolve()
-        input_dir.mkdir(exist_ok=True, parents=True)
-        input_dir.joinpath("mapped_reads", "duprem").mkdir(exist_ok=True, parents=True)
-        input_dir.joinpath("variants").mkdir(exist_ok=True, parents=True)
-        input_dir.joinpath("reference").mkdir(exist_ok=True, parents=True)
-
-        make_non_empty_file(
-            input_dir.joinpath("mapped_reads", "duprem", "sample_A.bam")
-        )
-        make_non_empty_file(input_dir.joinpath("variants", "sample_A.vcf"))
-        make_non_empty_file(input_dir.joinpath("reference", "reference.fasta"))
-
         pipeline = Pipeline(
-            **default_args, argv=["-i", str(input_dir)], input_type=("bam", "vcf")
+            **default_args,
+            argv=["-i", "fake_dir_juno_mapping_output"],
+            input_type=("bam", "vcf"),
         )
         pipeline.setup()
         self.assertTrue(pipeline.input_dir_is_juno_mapping_output)
@@ -641,18 +786,10 @@ class TestPipelineStartup(unittest.TestCase):
         """
         Testing that the pipeline recognizes the output of the Juno variant typing pipeline
         """
-
-        input_dir = Path("fake_dir_juno_variant_typing_output").resolve()
-        input_dir.mkdir(exist_ok=True, parents=True)
-        input_dir.joinpath("mtb_typing", "consensus").mkdir(exist_ok=True, parents=True)
-        input_dir.joinpath("audit_trail").mkdir(exist_ok=True, parents=True)
-
-        make_non_empty_file(
-            input_dir.joinpath("mtb_typing", "consensus", "sample_A.fasta")
-        )
-
         pipeline = Pipeline(
-            **default_args, argv=["-i", str(input_dir)], input_type=("fasta",)
+            **default_args,
+            argv=["-i", "fake_dir_juno_variant_typing_output"],
+            input_type=("fasta",),
         )
         pipeline.setup()
         self.assertTrue(pipeline.input_dir_is_juno_variant_typing_output)
@@ -661,34 +798,7 @@ class TestPipelineStartup(unittest.TestCase):
         """
         Testing that the pipeline recognizes the output of the Juno cgmlst pipeline
         """
-
-        input_dir = Path("fake_dir_juno_cgmlst_output").resolve()
-        input_dir.mkdir(exist_ok=True, parents=True)
-        input_dir.joinpath("cgmlst", "escherichia", "per_sample").mkdir(
-            exist_ok=True, parents=True
-        )
-        input_dir.joinpath("cgmlst", "shigella", "per_sample").mkdir(
-            exist_ok=True, parents=True
-        )
-        input_dir.joinpath("cgmlst", "stec", "per_sample").mkdir(
-            exist_ok=True, parents=True
-        )
-        input_dir.joinpath("audit_trail").mkdir(exist_ok=True, parents=True)
-
-        make_non_empty_file(
-            input_dir.joinpath("cgmlst", "escherichia", "per_sample", "sample_A.tsv")
-        )
-        make_non_empty_file(
-            input_dir.joinpath("cgmlst", "stec", "per_sample", "sample_A.tsv")
-        )
-        make_non_empty_file(
-            input_dir.joinpath("cgmlst", "shigella", "per_sample", "sample_A.tsv")
-        )
-
-        pipeline = Pipeline(
-            **default_args,
-            argv=["-i", str(input_dir)],
-        )
+        pipeline = Pipeline(**default_args, argv=["-i", "fake_dir_juno_cgmlst_output"])
         with self.assertRaises(NotImplementedError):
             pipeline.setup()
             self.assertTrue(pipeline.input_dir_is_juno_cgmlst_output)
@@ -706,26 +816,29 @@ class TestPipelineStartup(unittest.TestCase):
             )
             pipeline.setup()
 
+    def test_unlock_does_not_enlist_samples(self) -> None:
+        """Testing the pipeline startup does not look for (or validate) the
+        samples when only unlocking the output directory"""
+
+        pipeline = Pipeline(
+            **default_args,
+            argv=["-i", "fake_dir_incomplete", "--unlock"],
+            input_type="both",
+            min_num_lines=1000,
+        )
+        pipeline.setup()
+        self.assertEqual(pipeline.sample_dict, {})
+
     def test_junodir_wnumericsamplenames(self) -> None:
         """Testing the pipeline startup converts numeric file names to
         string"""
 
         expected_output = {
             "1234": {
-                "R1": str(
-                    Path("fake_dir_juno")
-                    .joinpath("clean_fastq", "1234_R1.fastq.gz")
-                    .resolve()
-                ),
-                "R2": str(
-                    Path("fake_dir_juno")
-                    .joinpath("clean_fastq", "1234_R2.fastq.gz")
-                    .resolve()
-                ),
+                "R1": str(self.juno_dir.joinpath("clean_fastq", "1234_R1.fastq.gz")),
+                "R2": str(self.juno_dir.joinpath("clean_fastq", "1234_R2.fastq.gz")),
                 "assembly": str(
-                    Path("fake_dir_juno")
-                    .joinpath("de_novo_assembly_filtered", "1234.fasta")
-                    .resolve()
+                    self.juno_dir.joinpath("de_novo_assembly_filtered", "1234.fasta")
                 ),
             }
         }
@@ -743,6 +856,52 @@ class TestPipelineStartup(unittest.TestCase):
             pipeline.juno_metadata, expected_metadata, pipeline.juno_metadata
         )
 
+    def test_metadata_csv_with_byte_order_mark(self) -> None:
+        """Testing that the metadata of a csv with a byte order mark (as
+        written by e.g. Excel) is read with the right column names"""
+        metadata_file = Path("metadata_with_bom.csv")
+        metadata_file.write_text(
+            "sample,genus\n1234,salmonella\n", encoding="utf-8-sig"
+        )
+        pipeline = Pipeline(**default_args, argv=["-i", "fake_dir_juno"])
+        pipeline.setup()
+        pipeline.get_metadata_from_csv_file(filepath=metadata_file)
+        self.assertEqual(pipeline.juno_metadata, {"1234": {"genus": "salmonella"}})
+
+    def test_metadata_csv_values_are_str(self) -> None:
+        """Testing that all the metadata values are str, and that an empty (or
+        missing) cell gives an empty str"""
+        metadata_file = Path("metadata_with_empty_cells.csv")
+        metadata_file.write_text(
+            "sample,genus,coverage,passed\n1234,salmonella,35.5,True\n5678,,\n"
+        )
+        pipeline = Pipeline(**default_args, argv=["-i", "fake_dir_juno"])
+        pipeline.setup()
+        pipeline.get_metadata_from_csv_file(filepath=metadata_file)
+        self.assertEqual(
+            pipeline.juno_metadata,
+            {
+                "1234": {"genus": "salmonella", "coverage": "35.5", "passed": "True"},
+                "5678": {"genus": "", "coverage": "", "passed": ""},
+            },
+        )
+
+    def test_fails_if_metadata_csv_is_malformed(self) -> None:
+        """Testing that a metadata csv with a sample in more than one row, or
+        with more values than column names, is not accepted"""
+        pipeline = Pipeline(**default_args, argv=["-i", "fake_dir_juno"])
+        pipeline.setup()
+        metadata_file = Path("malformed_metadata.csv")
+        for content, error_message in [
+            ("sample,genus\n1234,salmonella\n1234,listeria\n", "more than once"),
+            ("sample,genus\n1234,salmonella,enterica\n", "more values"),
+        ]:
+            with self.subTest(content=content), self.assertRaisesRegex(
+                ValueError, error_message
+            ):
+                metadata_file.write_text(content)
+                pipeline.get_metadata_from_csv_file(filepath=metadata_file)
+
     def test_fail_with_1_in_fastqname(self) -> None:
         """Testing the pipeline startup fails with wrong fastq naming (name
         contains _1_ in the sample name)"""
@@ -774,6 +933,8 @@ class TestPipelineStartup(unittest.TestCase):
             AssertionError, "does not contain one or more of the expected column names"
         ):
             pipeline.get_metadata_from_csv_file(expected_colnames=["Sample", "Genus"])
+        with self.assertRaisesRegex(AssertionError, "Missing: Genus"):
+            pipeline.get_metadata_from_csv_file(expected_colnames=["sample", "Genus"])
 
 
 class TestRunSnakemake(unittest.TestCase):
@@ -782,26 +943,44 @@ class TestRunSnakemake(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls) -> None:
-        with open("user_parameters.yaml", "a") as file_:
-            file_.write("fake_parameter: null")
-        with open("fixed_parameters.yaml", "a") as file_:
-            file_.write("fake_parameter: null")
-        with open("sample_sheet.yaml", "a") as file_:
-            file_.write("fake_sample: null")
-        os.mkdir("fake_input")
-        Path("fake_input/sample_a.fasta").touch()
-        Path("fake_input/sample_b.fasta").touch()
-        Path("fake_input/sample_c.fasta").touch()
-        make_non_empty_file(Path("fake_input/sample11233_R1.fastq"))
-        make_non_empty_file(Path("fake_input/sample11233_R2.fastq"))
+        for file_, content in [
+            ("user_parameters.yaml", "fake_parameter: null"),
+            ("fixed_parameters.yaml", "fake_parameter: null"),
+            ("sample_sheet.yaml", "fake_sample: null"),
+        ]:
+            Path(file_).write_text(content)
+        input_dir = Path("fake_input")
+        input_dir.mkdir(exist_ok=True)
+        for sample in ["sample_a", "sample_b", "sample_c"]:
+            input_dir.joinpath(f"{sample}.fasta").touch()
+        make_non_empty_file(input_dir.joinpath("sample11233_R1.fastq"))
+        make_non_empty_file(input_dir.joinpath("sample11233_R2.fastq"))
 
     @classmethod
     def tearDownClass(cls) -> None:
-        os.system("rm sample_sheet.yaml user_parameters.yaml fixed_parameters.yaml")
-        os.system("rm -rf fake_output_dir")
-        os.system("rm -rf fake_hpcoutput_dir")
-        os.system("rm -rf fake_input")
-        os.system("rm -rf exclusion_file.exclude")
+        for file_ in [
+            "sample_sheet.yaml",
+            "user_parameters.yaml",
+            "fixed_parameters.yaml",
+        ]:
+            Path(file_).unlink(missing_ok=True)
+        for folder in ["fake_output_dir", "fake_hpcoutput_dir", "fake_input"]:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def test_audit_trail_params_differ_per_pipeline(self) -> None:
+        """Testing that every pipeline gets its own run id"""
+        pipeline = Pipeline(**default_args, argv=default_argv)
+        other_pipeline = Pipeline(**default_args, argv=default_argv)
+        self.assertNotEqual(pipeline.unique_id, other_pipeline.unique_id)
+
+    def test_retries_are_passed_to_snakemake(self) -> None:
+        """Testing that --retries sets the restart_times of snakemake"""
+        pipeline = Pipeline(**default_args, argv=["-i", "fake_input"])
+        pipeline._parse_args()
+        self.assertEqual(pipeline.snakemake_args["restart_times"], 0)
+        pipeline = Pipeline(**default_args, argv=["-i", "fake_input", "--retries", "2"])
+        pipeline._parse_args()
+        self.assertEqual(pipeline.snakemake_args["restart_times"], 2)
 
     def test_fake_dryrun_setup(self) -> None:
         argv = [
@@ -836,6 +1015,37 @@ class TestRunSnakemake(unittest.TestCase):
         self.assertFalse(audit_trail_path.joinpath("user_parameters.yaml").is_file())
         self.assertFalse(audit_trail_path.joinpath("exclusion_file.exclude").is_file())
 
+    def test_unlock_keeps_audit_trail(self) -> None:
+        """Testing that unlocking the output directory does not overwrite the
+        sample sheet in the audit trail of the run that it unlocks"""
+        audit_sample_sheet = Path(
+            "fake_unlock_output_dir", "audit_trail", "sample_sheet.yaml"
+        )
+        audit_sample_sheet.parent.mkdir(parents=True, exist_ok=True)
+        self.addCleanup(shutil.rmtree, "fake_unlock_output_dir", ignore_errors=True)
+        audit_sample_sheet.write_text("s1: {R1: s1_R1.fastq, R2: s1_R2.fastq}\n")
+        pipeline = Pipeline(
+            argv=[
+                "-i",
+                "fake_input",
+                "-o",
+                "fake_unlock_output_dir",
+                "--local",
+                "--unlock",
+            ],
+            input_type="fastq",
+            pipeline_name="fake_pipeline",
+            pipeline_version="0.1",
+            sample_sheet=Path("sample_sheet.yaml"),
+            user_parameters_file=Path("user_parameters.yaml"),
+        )
+        pipeline.snakefile = str(Path("tests/Snakefile").resolve())
+        pipeline.run()
+        self.assertEqual(
+            audit_sample_sheet.read_text(), "s1: {R1: s1_R1.fastq, R2: s1_R2.fastq}\n"
+        )
+        self.assertFalse(audit_sample_sheet.with_name("log_pipeline.yaml").exists())
+
     def test_fake_run_setup(self) -> None:
         argv = [
             "-i",
@@ -870,41 +1080,28 @@ class TestRunSnakemake(unittest.TestCase):
         )
         # self.assertTrue(audit_trail_path.joinpath('exclusion_file.exclude').is_file())
 
-        pipeline_name_in_audit_trail = False
-        pipeline_version_in_audit_trail = False
-        with open(
-            pipeline.path_to_audit.joinpath("log_pipeline.yaml"), "r"
-        ) as git_pipeline_trail_file:
-            for line in git_pipeline_trail_file:
-                if "fake_pipeline" in line:
-                    pipeline_name_in_audit_trail = True
-                if "0.1" in line:
-                    pipeline_version_in_audit_trail = True
-        self.assertTrue(pipeline_name_in_audit_trail)
-        self.assertTrue(pipeline_version_in_audit_trail)
-
-        try:
-            is_repo = Path("/data/BioGrid/hernanda/").exists()
-        except:
-            is_repo = False
-
-        if is_repo:
-            repo_url_in_audit_trail = False
-            with open(
-                pipeline.path_to_audit.joinpath("log_git.yaml"), "r"
-            ) as git_audit_trail_file:
-                for line in git_audit_trail_file:
-                    if (
-                        "https://github.com/RIVM-bioinformatics/juno-library.git"
-                        in line
-                        or "git@github.com:RIVM-bioinformatics/juno-library.git" in line
-                    ):
-                        repo_url_in_audit_trail = True
-            self.assertTrue(repo_url_in_audit_trail)
+        pipeline_audit_trail = pipeline.path_to_audit.joinpath(
+            "log_pipeline.yaml"
+        ).read_text()
+        self.assertIn("fake_pipeline", pipeline_audit_trail)
+        self.assertIn("0.1", pipeline_audit_trail)
+        pipeline_info = yaml.safe_load(pipeline_audit_trail)
+        self.assertEqual(pipeline_info["run_id"], str(pipeline.unique_id))
+
+        if in_rivm_hpc:
+            git_audit_trail = pipeline.path_to_audit.joinpath(
+                "log_git.yaml"
+            ).read_text()
+            self.assertTrue(
+                "https://github.com/RIVM-bioinformatics/juno-library.git"
+                in git_audit_trail
+                or "git@github.com:RIVM-bioinformatics/juno-library.git"
+                in git_audit_trail
+            )
 
     def test_pipeline(self) -> None:
         output_dir = Path("fake_output_dir")
-        os.system(f'echo "output_dir: {str(output_dir)}" > user_parameters.yaml')
+        Path("user_parameters.yaml").write_text(f"output_dir: {str(output_dir)}\n")
 
         argv = [
             "-i",
@@ -927,12 +1124,12 @@ class TestRunSnakemake(unittest.TestCase):
         self.assertTrue(audit_trail_path.joinpath("snakemake_report.html").exists())
 
     @unittest.skipIf(
-        not Path("/data/BioGrid/hernanda/").exists(),
+        not in_rivm_hpc,
         "Skipped if not in RIVM HPC cluster",
     )
     def test_pipeline_in_hpcRIVM(self) -> None:
         output_dir = Path("fake_hpcoutput_dir")
-        os.system(f'echo "output_dir: {str(output_dir)}" > user_parameters.yaml')
+        Path("user_parameters.yaml").write_text(f"output_dir: {str(output_dir)}\n")
         pipeline = Pipeline(
             argv=[
                 "-i",
@@ -953,34 +1150,58 @@ class TestRunSnakemake(unittest.TestCase):
 class TestKwargsClass(unittest.TestCase):
     """Testing Argparse action to store kwargs (to be passed to Snakemake)"""
 
-    def test_kwargs_are_parsed(self) -> None:
-        parser = argparse.ArgumentParser(description="Testing parser")
-        parser.add_argument(
+    parser: argparse.ArgumentParser
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.parser = argparse.ArgumentParser(description="Testing parser")
+        cls.parser.add_argument(
             "--snakemake-args",
             nargs="*",
             default={},
             action=SnakemakeKwargsAction,
             help="Extra arguments to be passed to snakemake API (https://snakemake.readthedocs.io/en/stable/api_reference/snakemake.html).",
         )
-        self.assertRaisesRegex(
-            argparse.ArgumentTypeError,
-            "Make sure that you used the API format",
-            lambda: parser.parse_args(
-                ["--snakemake-args", "key1->value1", "resources"]
-            ),
-        )
-
-        self.assertRaisesRegex(
-            argparse.ArgumentTypeError,
-            "not specified in the snakemake python API",
-            lambda: parser.parse_args(["--snakemake-args", "key1=value1"]),
-        )
 
-        args = parser.parse_args(
-            ["--snakemake-args", "cores=1", "resources={'gpu':1}", "summary=True"]
-        )
-        expected_output = {"cores": 1, "resources": dict(gpu=1), "summary": True}
-        self.assertEqual(args.snakemake_args, expected_output, args.snakemake_args)
+    def test_kwargs_are_parsed(self) -> None:
+        failing_cases = [
+            (["key1->value1", "resources"], "Make sure that you used the API format"),
+            (["key1=value1"], "not specified in the snakemake python API"),
+        ]
+        for snakemake_args, error_message in failing_cases:
+            with self.subTest(snakemake_args=snakemake_args), self.assertRaisesRegex(
+                argparse.ArgumentTypeError, error_message
+            ):
+                self.parser.parse_args(["--snakemake-args", *snakemake_args])
+
+        parsed_cases = [
+            (
+                ["cores=1", "resources={'gpu':1}", "summary=True"],
+                {"cores": 1, "resources": dict(gpu=1), "summary": True},
+            ),
+            (
+                [
+                    "cluster_config=my config.yaml",
+                    "latency_wait=0.5",
+                    "conda_prefix=None",
+                    "workdir=4G",
+                    "until=²",
+                ],
+                {
+                    "cluster_config": "my config.yaml",
+                    "latency_wait": 0.5,
+                    "conda_prefix": None,
+                    "workdir": "4G",
+                    "until": "²",
+                },
+            ),
+        ]
+        for snakemake_args, expected_output in parsed_cases:
+            with self.subTest(snakemake_args=snakemake_args):
+                args = self.parser.parse_args(["--snakemake-args", *snakemake_args])
+                self.assertEqual(
+                    args.snakemake_args, expected_output, args.snakemake_args
+                )
 
 
 if __name__ == "__main__":